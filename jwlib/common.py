@@ -1,15 +1,32 @@
 import argparse
+import hashlib
+import http.client
+import io
+import json
 import os
 import pathlib
 import sys
-
+import threading
+import time
+import urllib.request
 from typing import List
+from urllib.error import HTTPError, URLError
 
 
 def msg(s):
     print(s, file=sys.stderr, flush=True)
 
 
+def cache_dir():
+    """Return directory for cached data, create it if needed"""
+
+    base = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA') \
+        or os.path.join(os.path.expanduser('~'), '.cache')
+    path = Path(base, 'jw-scripts')
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
 def action_factory(function):
     """Create an argparse.Action that will run the argument through a function before storing it"""
 
@@ -48,6 +65,163 @@ class Path(type(pathlib.Path()), pathlib.Path):
         return self.is_file() and self.suffix.lower() == '.mp4'
 
 
+class Fixtures:
+    """Saves HTTP responses in a directory (--record) or serves them from there (--replay)
+
+    Each response is stored as two files named after a hash of the request,
+    a .body file and a .json file with the URL, status, headers and the time
+    the request took. When replaying, the same time is spent waiting.
+    """
+
+    def __init__(self, directory: Path, replay=False):
+        self.directory = directory
+        self.replay = replay
+        if not replay:
+            directory.mkdir(parents=True, exist_ok=True)
+
+    def _name(self, method: str, url: str):
+        return hashlib.sha1('{} {}'.format(method, url).encode('utf-8')).hexdigest()
+
+    def load(self, method: str, url: str):
+        """Return status, headers, body of a recorded response
+
+        Raises URLError if there is no recording.
+        """
+        name = self._name(method, url)
+        try:
+            with (self.directory / (name + '.json')).open(encoding='utf-8') as f:
+                info = json.load(f)
+            body = (self.directory / (name + '.body')).read_bytes()
+        except (OSError, ValueError):
+            raise URLError('not recorded: {} {}'.format(method, url))
+
+        time.sleep(info['time'])
+        headers = http.client.HTTPMessage()
+        for key, value in info['headers']:
+            headers[key] = value
+        return info['status'], headers, body
+
+    def save(self, method: str, url: str, status: int, headers, body: bytes, elapsed: float):
+        name = self._name(method, url)
+        info = {'method': method, 'url': url, 'status': status, 'headers': list(headers.items()), 'time': elapsed}
+        (self.directory / (name + '.body')).write_bytes(body)
+        with (self.directory / (name + '.json')).open('w', encoding='utf-8') as f:
+            json.dump(info, f, indent=2)
+
+
+class Metrics:
+    """Counters and gauges for Prometheus
+
+    The file is meant for the textfile collector of the node exporter.
+    Names ending with _total are counters, the rest are gauges.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # type: dict # (name, ((label, value), ...)): number
+
+    def _key(self, name: str, labels: dict):
+        # Label values are strings in the output, and must be comparable for sorting
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name: str, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def write(self, file: Path):
+        """Write all metrics to a file (replacing it atomically, so it's never read half-written)"""
+
+        lines = []
+        typed = set()
+        with self.lock:
+            values = sorted(self.values.items())
+        for (name, labels), value in values:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(name, 'counter' if name.endswith('_total') else 'gauge'))
+            if labels:
+                label_string = ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                                        for k, v in labels)
+                lines.append('{}{{{}}} {}'.format(name, label_string, value))
+            else:
+                lines.append('{} {}'.format(name, value))
+
+        tmpfile = file.with_name(file.name + '.part')
+        try:
+            with tmpfile.open('w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            tmpfile.replace(file)
+        except OSError as e:
+            msg('could not write metrics: {}'.format(e))
+
+
+# Metrics for the whole process (written with --metrics)
+metrics = Metrics()
+
+# Set by use_fixtures()
+_fixtures = None  # type: Fixtures
+
+
+def use_fixtures(directory: Path, replay=False):
+    """Record or replay all API requests made from now on"""
+
+    global _fixtures
+    _fixtures = Fixtures(directory, replay)
+
+
+def get_fixtures():
+    return _fixtures
+
+
+def open_url(url: str, timeout=30):
+    """Like urllib.request.urlopen(), but can be recorded and replayed
+
+    When recording or replaying, the whole response is kept in memory.
+    HTTP errors are raised like urlopen() does.
+    """
+    start = time.monotonic()
+    status = 'error'
+    try:
+        response = _open_url(url, timeout)
+        status = response.status
+        return response
+    except HTTPError as e:
+        status = e.code
+        raise
+    finally:
+        # Time until the headers arrived
+        metrics.inc('jwb_index_api_requests_total', status=status)
+        metrics.inc('jwb_index_api_request_seconds_total', time.monotonic() - start)
+
+
+def _open_url(url: str, timeout: int):
+    if not _fixtures:
+        return urllib.request.urlopen(url, timeout=timeout)
+
+    if _fixtures.replay:
+        status, headers, body = _fixtures.load('GET', url)
+    else:
+        start = time.time()
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                status, headers, body = response.status, response.headers, response.read()
+        except HTTPError as e:
+            status, headers, body = e.code, e.headers, e.read()
+        _fixtures.save('GET', url, status, headers, body, time.time() - start)
+
+    if status >= 400:
+        raise HTTPError(url, status, http.client.responses.get(status, ''), headers, io.BytesIO(body))
+    response = io.BytesIO(body)
+    response.status = status
+    return response
+
+
 class Settings:
     """Global settings and defaults"""
 
@@ -55,6 +229,14 @@ class Settings:
 
     quiet = 0  # type: int
     list_languages = False  # type: bool
+    record_dir = None  # type: Path
+    metrics_file = None  # type: Path
+    replay_dir = None  # type: Path
+
+    # Daemon mode
+    daemon = False  # type: bool
+    interval = 60  # type: int # minutes
+    status_file = None  # type: Path
 
     # Depending on mode
     positional_arguments = []  # type: List[str]
@@ -65,31 +247,50 @@ class Settings:
 
     # API parsing stuff
     lang = 'E'  # type: str
+    languages = ['E']  # type: List[str]
     quality = 1080  # type: int
     hard_subtitles = False  # type:bool
     min_date = 0  # type: int # 1970-01-01
     include_categories = ['VideoOnDemand']  # type: List[str]
     exclude_categories = ['VODSJJMeetings']  # type: List[str]
-    filter_categories = []  # type: List[str]
+    filter_categories = set()  # type: set
+    filter_subtree = False  # type: bool
     print_category = ''  # type: str
     latest = False  # type: bool
 
     # Disk space check stuff
     keep_free = 0  # type: int # bytes
+    fit_items = 0  # type: int # choose quality so this many videos fit on disk
     warning = True  # type: bool # warn if limit is set too low
 
-    import_dir = None  # type: Path
+    # Dry run
+    plan = False  # type: bool
+    plan_json = None  # type: Path # '-' for stdout
+
+    import_dirs = []  # type: List[Path]
+    jobs = 4  # type: int
 
     # Download stuff
     download = False  # type: bool
     download_subtitles = False  # type: bool
     friendly_filenames = False  # type: bool
     rate_limit = 1.0  # type: float # MB/s
+    rate_schedule = []  # type: List[tuple] # (minute of day, MB/s)
+    shared_rate = False  # type: bool
+    timeout = 30  # type: int # seconds
+    retries = 5  # type: int
     checksums = False  # type: bool
+    check_remote = False  # type: bool
+    dedup = False  # type: bool
     overwrite_bad = False  # type: bool
+    progress_json = None  # type: Path
+    queue_order = 'newest'  # type: str
+    priority_categories = []  # type: List[str]
 
     # Output stuff
     append = False  # type: bool
+    max_items = 0  # type: int # 0 = no limit
+    max_category_items = 0  # type: int # 0 = no limit
     clean_all_symlinks = False  # type: bool
     update = False  # type: bool
     mode = ''  # type: str
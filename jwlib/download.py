@@ -1,13 +1,86 @@
+import atexit
+import bisect
+import errno
 import hashlib
+import heapq
+import http.client
+import json
+import os
+import random
 import shutil
+import socket
+import threading
 import time
 import urllib.parse
 import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import zip_longest
 from sys import stderr
-from typing import List
+from typing import Dict, List, Tuple
+from urllib.error import HTTPError, URLError
 
-from .common import Path, Settings, msg
-from .parse import Category, Media
+from .common import Path, Settings, cache_dir, get_fixtures, metrics, msg
+from .parse import Category, Media, get_best_video, set_filename_style
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import ctypes
+    _libc = ctypes.CDLL(None, use_errno=True)
+    # fallocate() takes a 32 bit off_t on 32 bit glibc, fallocate64() always takes 64 bits
+    # (musl only has fallocate(), but its off_t is always 64 bits)
+    _fallocate = getattr(_libc, 'fallocate64', None) or _libc.fallocate
+    _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+except (ImportError, OSError, AttributeError, TypeError):
+    # Not Linux
+    _fallocate = None
+
+# ioctl request to clone a file (reflink) on Linux btrfs/xfs
+FICLONE = 0x40049409
+
+# A download is considered stalled if it gets less than this many bytes/s
+STALL_MIN_RATE = 1024
+# ...during this many seconds
+STALL_WINDOW = 60
+
+# Wait between retries: 5, 10, 20 s... up to 5 min (with some random jitter)
+RETRY_BASE_DELAY = 5
+RETRY_MAX_DELAY = 300
+
+# Weight of the latest measurement in the average download speed
+THROUGHPUT_WEIGHT = 0.3
+
+# Seconds between progress updates on a terminal, in logs and in --progress-json
+PROGRESS_INTERVAL = 0.5
+PROGRESS_LOG_INTERVAL = 60
+PROGRESS_JSON_INTERVAL = 5
+# Weight of the latest measurement in the smoothed download speed
+PROGRESS_SMOOTHING = 0.3
+
+# Seconds before a .part file that nobody wants gets deleted
+PART_MAX_AGE = 7 * 24 * 60 * 60
+
+# Seconds before a disk space reservation of another process is ignored
+RESERVATION_TIMEOUT = 24 * 60 * 60
+
+# Buffer for writing downloads (fewer and bigger writes fragment the file less)
+WRITE_BUFFER = 1024 * 1024
+
+# From linux/falloc.h: allocate blocks but leave the file size as it is
+FALLOC_FL_KEEP_SIZE = 1
+
+# Directory for the content store, inside the work dir
+STORE_DIR = 'jwb-store'
+
+# Seconds before a process is no longer counted by BandwidthShare
+SHARE_TIMEOUT = 5
+
+# Errors that may go away if we try again
+NETWORK_ERRORS = (URLError, ConnectionError, socket.timeout, http.client.HTTPException)
 
 
 class MissingTimestampError(Exception):
@@ -18,75 +91,864 @@ class DiskLimitReached(Exception):
     pass
 
 
+class StallError(socket.timeout):
+    pass
+
+
+class Manifest:
+    """Sizes and MD5 checksums of the files in a directory
+
+    The manifest is stored as JSON next to the files. An entry is only
+    trusted as long as the file still has the same size and mtime.
+    """
+    filename = 'manifest.json'
+
+    def __init__(self, directory: Path):
+        self.file = directory / self.filename
+        self.data = {}
+        self.lock = threading.Lock()
+        try:
+            with self.file.open(encoding='utf-8') as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def key(self, file: Path) -> str:
+        return file.name
+
+    def get_md5(self, file: Path) -> str:
+        """Return checksum of a file, or empty string if unknown or outdated"""
+        entry = self.data.get(self.key(file))
+        try:
+            if entry and entry['size'] == file.size and entry['mtime'] == int(file.mtime):
+                return entry['md5']
+        except (OSError, KeyError, TypeError):
+            pass
+        return ''
+
+    def set_md5(self, file: Path, md5: str):
+        with self.lock:
+            self.data[self.key(file)] = {'size': file.size, 'mtime': int(file.mtime), 'md5': md5}
+
+    def save(self):
+        """Write manifest to disk (if the directory exists)"""
+        if not self.data:
+            return
+        tmpfile = self.file.with_name(self.filename + '.part')
+        with self.lock:
+            try:
+                with tmpfile.open('w', encoding='utf-8') as f:
+                    json.dump(self.data, f)
+                tmpfile.replace(self.file)
+            except OSError:
+                pass
+
+
+class RemoteInfo(Manifest):
+    """HTTP headers (ETag, Last-Modified etc) of downloaded files
+
+    Used to make conditional requests, or to detect changes on the server.
+    """
+    filename = 'remote.json'
+
+    def get(self, file: Path) -> dict:
+        return self.data.get(self.key(file), {})
+
+    def set(self, file: Path, headers):
+        info = {k: headers[k] for k in ('ETag', 'Last-Modified', 'Content-Length') if headers.get(k)}
+        # Partial response, total size is after the slash: bytes 100-199/200
+        if headers.get('Content-Range'):
+            info['Content-Length'] = headers['Content-Range'].rpartition('/')[2]
+        with self.lock:
+            self.data[self.key(file)] = info
+
+    def has_changed(self, file: Path, headers):
+        """Compare response headers to the stored ones (or the local file size)"""
+        info = self.get(file)
+        length = headers.get('Content-Length')
+        if not info:
+            return bool(length) and int(length) != file.size
+        for k in ('ETag', 'Last-Modified', 'Content-Length'):
+            if info.get(k) and headers.get(k) and info[k] != headers[k]:
+                return True
+        return False
+
+
+class Journal:
+    """Write-ahead log of the downloads in a directory
+
+    Before downloading, the queue is written to journal.jsonl, and then a
+    line is added when each file is started and finished. Every line is
+    synced to disk. The journal is removed when the queue is done, so if it
+    still exists, the last run was interrupted and remaining() tells what
+    was left to do.
+    """
+    filename = 'journal.jsonl'
+
+    def __init__(self, directory: Path):
+        self.file = directory / self.filename
+        self.fd = None
+
+    def remaining(self) -> List[Media]:
+        """Return media that was queued but not finished in an interrupted run"""
+
+        queued = {}  # type: Dict[str, Media] # URL: media
+        try:
+            with self.file.open(encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line may be incomplete
+                        break
+                    if record['op'] == 'queue':
+                        media = Media()
+                        for key in ('url', 'name', 'size', 'md5', 'date', 'duration', 'subtitle_url'):
+                            setattr(media, key, record[key])
+                        queued[media.url] = media
+                    elif record['op'] == 'done':
+                        queued.pop(record['url'], None)
+        except (OSError, KeyError, TypeError):
+            pass
+        return list(queued.values())
+
+    def begin(self, queue: List[Media]):
+        """Start a new journal with the queue"""
+
+        self.file.parent.mkdir(exist_ok=True)
+        tmpfile = self.file.with_name(self.filename + '.part')
+        with tmpfile.open('w', encoding='utf-8') as f:
+            for media in queue:
+                f.write(json.dumps({'op': 'queue', 'url': media.url, 'name': media.name, 'size': media.size,
+                                    'md5': media.md5, 'date': media.date, 'duration': media.duration,
+                                    'subtitle_url': media.subtitle_url}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        tmpfile.replace(self.file)
+        self.fd = self.file.open('a', encoding='utf-8')
+
+    def write(self, op: str, media: Media):
+        if not self.fd:
+            return
+        self.fd.write(json.dumps({'op': op, 'url': media.url, 'file': media.filename}) + '\n')
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+
+    def started(self, media: Media):
+        self.write('start', media)
+
+    def finished(self, media: Media, ok=True):
+        self.write('done' if ok else 'failed', media)
+
+    def close(self, complete=False):
+        """Close the journal, and remove it if the whole queue has been handled"""
+
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+        if complete:
+            try:
+                self.file.unlink()
+            except OSError:
+                pass
+
+
+class HashCache(Manifest):
+    """Checksums of files in other directories (like import sources)"""
+    filename = 'hashes.json'
+
+    def key(self, file: Path):
+        return str(file.absolute())
+
+
 def download_all(s: Settings, data: List[Category]):
     """Download/check media files"""
 
-    wd = s.work_dir / s.sub_dir
+    download_all_languages([(s, data)])
 
-    media_list = [x for cat in data
-                  for x in cat.contents
-                  if isinstance(x, Media)]
-    # Sort download queue with newest files first
-    # This is important for the --free flag's disk_cleanup() to work as expected
-    media_list = sorted(media_list, key=lambda x: x.date or 0, reverse=True)
+
+def download_unfinished(settings_list: List[Settings]):
+    """Finish the downloads of an interrupted run, without waiting for indexing"""
+
+    jobs = []
+    for ls in settings_list:
+        media_list = Journal(ls.work_dir / ls.sub_dir).remaining()
+        if media_list:
+            category = Category()
+            category.key = 'journal'
+            category.contents = media_list
+            jobs.append((ls, [category]))
+    if not jobs:
+        return
+
+    s = jobs[0][0]
+    set_filename_style(s)
+    if s.quiet < 2:
+        msg('resuming {} unfinished downloads'.format(sum(len(data[0].contents) for _, data in jobs)))
+    plan = DownloadPlan(jobs)
+    plan.scan()
+    plan.run()
+
+
+def download_all_languages(jobs: List[Tuple[Settings, List[Category]]]):
+    """Download/check media files for one or more languages
+
+    :param jobs: list of (settings, data) for each language, global settings are taken from the first
+    """
+    plan = DownloadPlan(jobs)
+    s = plan.s
 
     if s.download_subtitles:
-        download_all_subtitles(s, media_list, wd)
+        for wd in plan.directories:
+            # Share the RemoteInfo, or the plan would overwrite the subtitle headers with its stale copy
+            download_all_subtitles(s, [media for media, d in plan.queue if d == wd], wd, plan.remote_infos[wd])
 
     if not s.download:
         return
 
-    # Search for local media before initiating the download
-    # (to get correct progress info for the download in next step)
-    if s.quiet < 1:
-        msg('scanning local files')
+    plan.scan()
+    plan.run()
 
-    checked_files = []
-    download_list = []
-    for media in media_list:
-        # Only run this check once per filename
-        # (there may be multiple Media objects referring to the same file)
-        if media.filename not in checked_files:
-            checked_files.append(media.filename)
-            if not check_media(s, media, wd):
-                # Queue missing or bad files
-                download_list.append(media)
-
-    # Start downloading
-    for num, media in enumerate(download_list):
+
+class DownloadPlan:
+    """Find out what needs to be downloaded, and do it
+
+    All languages share the same download queue and disk space limit.
+    Files with the same URL are only downloaded once, and then linked
+    into the directories of the other languages.
+
+    With --dedup, files are also linked into a store where the name is the
+    MD5 checksum, so the same content is only downloaded once, whatever name it has.
+
+    Nothing is changed on disk until run() is called.
+    """
+
+    def __init__(self, jobs: List[Tuple[Settings, List[Category]]]):
+        """
+        :param jobs: list of (settings, data) for each language, global settings are taken from the first
+        """
+        self.s = jobs[0][0]
+
+        # List of (Media, directory)
+        self.queue = []
+        # The category each media was first found in
+        found_in = {}  # type: Dict[Tuple[Path, Media], Category]
+        for ls, data in jobs:
+            wd = ls.work_dir / ls.sub_dir
+            selected = {}  # type: Dict[str, Media] # filename: media
+            for cat in data:
+                media_items = [x for x in cat.contents if isinstance(x, Media)]
+                if ls.max_category_items > 0:
+                    media_items = heapq.nlargest(ls.max_category_items, media_items, key=lambda x: x.date or 0)
+                for media in media_items:
+                    found_in.setdefault((wd, selected.setdefault(media.filename, media)), cat)
+            media_items = selected.values()
+            if ls.max_items > 0:
+                media_items = heapq.nlargest(ls.max_items, media_items, key=lambda x: x.date or 0)
+            self.queue += [(media, wd) for media in media_items]
+
+        # Sort download queue with newest files first
+        # This is important for the --free flag's disk_cleanup() to work as expected
+        self.queue.sort(key=lambda x: x[0].date or 0, reverse=True)
+
+        self.directories = list(dict.fromkeys(wd for _, wd in self.queue))
+        # Directories where files may get deleted by --free
+        self.cleanup_dirs = self.directories + ([self.s.work_dir / STORE_DIR] if self.s.dedup else [])
+
+        if self.s.fit_items:
+            self.fit_quality([m for _, data in jobs for cat in data for m in cat.contents if isinstance(m, Media)])
+
+        # Filenames are only known after fit_quality()
+        self.categories = {}  # type: Dict[Tuple[Path, str], Category] # (dir, filename): category
+        for media, wd in self.queue:
+            self.categories.setdefault((wd, media.filename), found_in[wd, media])
+
+        self.links = []  # type: List[Tuple[Path, Path]] # (existing file, new link)
+        self.downloads = []  # type: List[Tuple[Media, Path]]
+        self.skipped = []  # type: List[Tuple[Media, Path]] # won't fit on disk
+        self.copies = {}  # type: Dict[str, List[Tuple[Media, Path]]] # URL: places to link a download to
+        self.stale_files = []  # type: List[Path] # store files to delete before downloading
+        self.remote_infos = {wd: RemoteInfo(wd) for wd in self.directories}
+
+    def fit_quality(self, all_media: List[Media]):
+        """Choose smaller files for older videos, until the newest ones fit on disk
+
+        With --free, all space used by videos counts as available, since it may delete them.
+        Videos that already exist in some quality are left as they are.
+
+        :param all_media: all Media objects, the chosen file is applied to those with the same URL too
+        """
+        s = self.s
+
+        budget = shutil.disk_usage(str(s.work_dir)).free - s.keep_free
         if s.keep_free > 0:
-            try:
-                disk_cleanup(s, wd, media)
-            except MissingTimestampError:
+            budget += sum(size for _, size, _ in self.videos_on_disk())
+
+        items = self.queue[:s.fit_items]
+        original_urls = {media: media.url for media, _ in items}
+        adjustable = []
+        for media, wd in items:
+            for j_file in media.files:
+                # Keep the file we already have
+                candidate = Media()
+                candidate.name = media.name
+                candidate.set_file(j_file)
+                file = wd / candidate.filename
+                if not file.exists():
+                    continue
+                # With --friendly all qualities have the same name
+                if s.friendly_filenames and j_file.get('filesize') and file.size != j_file['filesize']:
+                    continue
+                media.set_file(j_file)
+                break
+            else:
+                adjustable.append(media)
+
+        needed = sum(media.size or 0 for media, _ in items)
+        # Step down the oldest videos first
+        for media in reversed(adjustable):
+            while needed > budget and media.files and media.size:
+                j_file = get_best_video(media.files, s.quality, s.hard_subtitles, max_size=media.size - 1)
+                if not (0 < (j_file.get('filesize') or 0) < media.size):
+                    break
+                needed -= media.size - j_file['filesize']
+                if s.quiet < 1:
+                    msg('lowering quality: {} ({})'.format(media.name, j_file.get('label')))
+                media.set_file(j_file)
+
+        if needed > budget and s.quiet < 2:
+            msg('warning: {} videos will not fit on disk, even in the lowest quality'.format(len(items)))
+
+        # The same video in other categories (not in the queue) should point to the same file
+        same_url = {}  # type: Dict[str, List[Media]]
+        for media in all_media:
+            same_url.setdefault(media.url, []).append(media)
+        for media, url in original_urls.items():
+            if media.url == url:
+                continue
+            j_file = next(f for f in media.files if f['progressiveDownloadURL'] == media.url)
+            for other in same_url.get(url, []):
+                if other is not media:
+                    other.set_file(j_file)
+
+    def scan(self):
+        """Search for local media, to see what needs to be downloaded"""
+
+        s = self.s
+        if s.quiet < 1:
+            msg('scanning local files')
+
+        checked_files = set()
+        found = []
+        missing = {}  # type: Dict[str, List[Tuple[Media, Path]]] # URL: [(media, dir), ...]
+        existing = {}  # type: Dict[str, Path] # URL: file
+        store_links = {}  # type: Dict[str, List[Tuple[Path, Path]]] # URL: [(file, store file), ...]
+        for media, wd in self.queue:
+            # Only run this check once per filename
+            # (there may be multiple Media objects referring to the same file)
+            if (wd, media.filename) not in checked_files:
+                checked_files.add((wd, media.filename))
+                if check_media(s, media, wd):
+                    found.append((media, wd))
+                    existing.setdefault(media.url, wd / media.filename)
+                    store_file = get_store_file(s, media)
+                    if store_file and not store_file.exists():
+                        store_links.setdefault(media.url, []).append((wd / media.filename, store_file))
+                else:
+                    # Queue missing or bad files
+                    missing.setdefault(media.url, []).append((media, wd))
+
+        # Ask the server if existing files have changed
+        changed = set()
+        if s.check_remote and found:
+            if s.quiet < 1:
+                msg('checking for changes on server')
+            for media, wd in find_remote_changes(s, found, self.remote_infos):
                 if s.quiet < 2:
-                    msg('low disk space and missing metadata, skipping: {}'.format(media.name))
+                    msg('changed on server: {}'.format(media.filename))
+                changed.add(media.url)
+                missing.setdefault(media.url, []).append((media, wd))
+
+        # Old content must not end up in the store
+        for url, links in store_links.items():
+            if url not in changed:
+                self.links += links
+
+        for url, places in missing.items():
+            # Files that exist in another language don't need to be downloaded
+            if url in existing and url not in changed:
+                self.links += [(existing[url], wd / media.filename) for media, wd in places]
+                continue
+            # Files with the same content exist in the store
+            store_file = get_store_file(s, places[0][0])
+            if store_file and store_file.exists():
+                if url in changed:
+                    # The checksum in the store is from before the change
+                    self.stale_files.append(store_file)
+                else:
+                    self.links += [(store_file, wd / media.filename) for media, wd in places]
+                    continue
+            self.downloads.append(places[0])
+            self.copies[url] = places[1:]
+
+        if s.keep_free > 0 and s.queue_order != 'newest':
+            # Leave out what would not fit on disk when downloading newest first, or
+            # older videos could get downloaded only to be deleted to make room for newer ones
+            self.downloads, _, self.skipped = self.simulate(self.downloads, in_order=True)
+        self.downloads = QUEUE_ORDERS[s.queue_order](s, self.downloads, self.categories)
+
+    def clean_part_files(self):
+        """Delete old partial downloads of files that are not in the queue"""
+
+        s = self.s
+        wanted = {wd / (media.filename + '.part') for media, wd in self.queue}
+        for wd in self.directories:
+            if not wd.exists():
                 continue
-            except DiskLimitReached:
-                return
+            for file in wd.glob('*.part'):
+                try:
+                    if file in wanted or time.time() - file.mtime < PART_MAX_AGE:
+                        continue
+                    if s.quiet < 2:
+                        msg('removing old partial download: {}'.format(file))
+                    file.unlink()
+                except OSError:
+                    pass
+
+    def run(self):
+        """Create links and download files"""
+
+        s = self.s
+        self.clean_part_files()
+        for file in self.stale_files:
+            if s.quiet < 1:
+                msg('removing outdated file: {}'.format(file))
+            try:
+                file.unlink()
+            except OSError:
+                pass
+        for source, dest in self.links:
+            _link_file(s, source, dest)
+
+        manifests = {wd: Manifest(wd) for wd in self.directories}
+        throughput = _load_throughput()
+        progress = Progress(s, [media for media, _ in self.downloads])
+        metrics.set('jwb_index_files_queued', len(self.downloads))
+        journals = {wd: Journal(wd) for wd in dict.fromkeys(wd for _, wd in self.downloads)}
+        for wd, journal in journals.items():
+            journal.begin([media for media, d in self.downloads if d == wd])
+        complete = False
+
+        try:
+            # Start downloading
+            for num, (media, wd) in enumerate(self.downloads):
+                if s.keep_free > 0:
+                    if not media.size:
+                        media.size = _remote_size(s, media.url)
+                    try:
+                        disk_cleanup(s, wd, media, other_dirs=self.cleanup_dirs)
+                    except MissingTimestampError:
+                        if s.quiet < 2:
+                            msg('low disk space and missing metadata, skipping: {}'.format(media.name))
+                        progress.finish_file(media, ok=False)
+                        journals[wd].finished(media, ok=False)
+                        continue
+                    except DiskLimitReached:
+                        if s.queue_order == 'newest':
+                            break
+                        # The rest of the queue may still contain newer videos
+                        progress.finish_file(media, ok=False)
+                        journals[wd].finished(media, ok=False)
+                        continue
+                    except OSError as e:
+                        if e.errno != errno.ENOSPC:
+                            raise
+                        progress.clear()
+                        msg(e.strerror)
+                        break
+
+                # Download the video
+                if s.quiet < 2:
+                    print('[{}/{}]'.format(num + 1, len(self.downloads)), end=' ', file=stderr)
+                started = time.time()
+                progress.start_file(media)
+                journals[wd].started(media)
+                try:
+                    ok = download_media(s, media, wd, self.remote_infos[wd], progress)
+                except OSError as e:
+                    if e.errno != errno.ENOSPC:
+                        raise
+                    progress.clear()
+                    msg('not enough disk space for: {}'.format(media.filename))
+                    ok = False
+                progress.finish_file(media, ok)
+                journals[wd].finished(media, ok)
+                if not ok:
+                    metrics.inc('jwb_index_files_failed_total')
+                    continue
+
+                # Measure download speed, for estimates
+                elapsed = time.time() - started
+                if media.size and elapsed > 1 and not current_rate_limit(s):
+                    speed = media.size / elapsed
+                    throughput = throughput + THROUGHPUT_WEIGHT * (speed - throughput) if throughput else speed
+
+                if media.md5:
+                    # Remember checksum for --import on other machines
+                    manifests[wd].set_md5(wd / media.filename, media.md5)
+                    manifests[wd].save()
+                for other_media, other_wd in self.copies[media.url]:
+                    _link_file(s, wd / media.filename, other_wd / other_media.filename)
+                store_file = get_store_file(s, media)
+                if store_file:
+                    _link_file(s, wd / media.filename, store_file)
+            complete = True
+        finally:
+            for journal in journals.values():
+                journal.close(complete)
+            progress.close()
+            _save_throughput(throughput)
+
+    def simulate(self, downloads: List[Tuple[Media, Path]], in_order=False):
+        """Replay the --free logic of disk_cleanup() without touching any files
+
+        :param downloads: list of (media, dir)
+        :param in_order: if True, the list is sorted newest first (stop when the disk limit is reached)
+        :return: tuple of (downloaded, deleted, skipped), where deleted is a list of (mtime, size, file)
+        """
+        s = self.s
+
+        free = shutil.disk_usage(str(s.work_dir)).free
+        # List of (mtime, size, file), oldest first
+        # Hard links only free space when the last one is gone, so they count as one file
+        videos = self.videos_on_disk()
+        on_disk = sorted((mtime, size, files[0]) for mtime, size, files in videos)
+        other_links = {files[0]: files[1:] for _, _, files in videos}
+
+        downloaded = []
+        deleted = []  # type: List[Tuple[float, int, str]]
+        skipped = []
+        for num, (media, wd) in enumerate(downloads):
+            size = media.size or 0
+            if s.keep_free > 0 and free <= size + s.keep_free:
+                if not media.date:
+                    skipped.append((media, wd))
+                    continue
+                while free <= size + s.keep_free and on_disk and media.date > on_disk[0][0]:
+                    oldest = on_disk.pop(0)
+                    deleted.append(oldest)
+                    deleted += [(oldest[0], 0, link) for link in other_links.get(oldest[2], [])]
+                    free += oldest[1]
+                if free <= size + s.keep_free:
+                    # Disk limit reached
+                    if in_order:
+                        skipped += downloads[num:]
+                        break
+                    skipped.append((media, wd))
+                    continue
+            downloaded.append((media, wd))
+            free -= size
+            # Files downloaded now may get deleted later on, unless the queue is sorted by age
+            bisect.insort(on_disk, (media.date or 0, size, str(wd / media.filename)))
+
+        return downloaded, deleted, skipped
+
+    def videos_on_disk(self):
+        """Return videos in the cleanup directories as a list of (mtime, size, [file, hard links...])"""
+
+        inodes = {}  # type: Dict[Tuple[int, int], Tuple[float, int, List[str]]] # (device, inode): entry
+        for d in self.cleanup_dirs:
+            if d.exists():
+                for f in d.iterdir():
+                    if f.is_mp4():
+                        st = f.stat()
+                        inodes.setdefault((st.st_dev, st.st_ino), (st.st_mtime, st.st_size, []))[2].append(str(f))
+        return list(inodes.values())
+
+    def estimate(self):
+        """Predict the outcome of run() without doing anything
+
+        :return: dict with lists of files to download and delete, and totals
+        """
+        s = self.s
+        downloads, evict, skipped = self.simulate(self.downloads, in_order=s.queue_order == 'newest')
+        skipped = self.skipped + skipped
+
+        total = sum(media.size or 0 for media, _ in downloads)
+        rate = current_rate_limit(s) * 1024 * 1024 or _load_throughput()
+
+        return {
+            'downloads': [{'file': str(wd / media.filename), 'url': media.url, 'size': media.size or 0,
+                           'date': media.date or 0} for media, wd in downloads],
+            'links': [{'source': str(source), 'link': str(dest)} for source, dest in self.links],
+            'delete': [{'file': file, 'size': size} for _, size, file in evict],
+            'skipped': [{'file': str(wd / media.filename), 'url': media.url} for media, wd in skipped],
+            'total_bytes': total,
+            'delete_bytes': sum(size for _, size, _ in evict),
+            'rate': rate,  # bytes/s
+            'eta': total / rate if rate else None  # seconds
+        }
+
+
+def order_newest(s: Settings, downloads: List[Tuple[Media, Path]], categories: dict):
+    """Newest videos first (the queue is already sorted like this)"""
+    return downloads
+
+
+def order_smallest(s: Settings, downloads: List[Tuple[Media, Path]], categories: dict):
+    """Smallest files first, to get as many complete videos as possible"""
+    return sorted(downloads, key=lambda x: x[0].size or 0)
+
+
+def order_round_robin(s: Settings, downloads: List[Tuple[Media, Path]], categories: dict):
+    """One video from each category at a time, newest first"""
+
+    groups = {}  # type: Dict[Category, List[Tuple[Media, Path]]]
+    for media, wd in downloads:
+        groups.setdefault(categories[wd, media.filename], []).append((media, wd))
+    return [x for batch in zip_longest(*groups.values()) for x in batch if x]
+
+
+def order_priority(s: Settings, downloads: List[Tuple[Media, Path]], categories: dict):
+    """Categories from --priority first, in that order, then home categories, then the rest"""
+
+    def weight(item):
+        category = categories[item[1], item[0].filename]
+        if category.key in s.priority_categories:
+            return s.priority_categories.index(category.key)
+        elif category.home:
+            return len(s.priority_categories)
+        else:
+            return len(s.priority_categories) + 1
+
+    # Sorting is stable, so it's still newest first within each group
+    return sorted(downloads, key=weight)
+
+
+# Ways to sort the download queue, for --queue
+# They take (settings, list of (media, dir), {(dir, filename): category}) and return a new list
+QUEUE_ORDERS = {
+    'newest': order_newest,
+    'smallest': order_smallest,
+    'round-robin': order_round_robin,
+    'priority': order_priority,
+}
+
+
+def _load_throughput():
+    """Return average download speed in bytes/s, or 0 if unknown"""
+    try:
+        with (cache_dir() / 'throughput.json').open(encoding='utf-8') as f:
+            return float(json.load(f)['bytes_per_second'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0.0
+
+
+def _save_throughput(speed: float):
+    if not speed:
+        return
+    try:
+        with (cache_dir() / 'throughput.json').open('w', encoding='utf-8') as f:
+            json.dump({'bytes_per_second': speed}, f)
+    except OSError:
+        pass
+
+
+def _remote_size(s: Settings, url: str):
+    """Ask the server for the size of a file, return 0 if unknown"""
+    try:
+        status, headers, body = http_request('HEAD', url, timeout=s.timeout)
+        return int(headers['Content-Length']) if status == 200 else 0
+    except NETWORK_ERRORS + (TypeError, ValueError):
+        return 0
+
+
+def find_remote_changes(s: Settings, files: List[Tuple[Media, Path]], remote_infos: Dict[Path, RemoteInfo]):
+    """Send HEAD requests in parallel, and return the files that have changed on the server
+
+    Files without any stored headers are compared by size, and their headers are stored.
+
+    :param files: list of (media, directory)
+    :param remote_infos: directory: RemoteInfo
+    """
+
+    def check(item):
+        media, wd = item
+        file = wd / media.filename
+        try:
+            status, headers, _ = http_request('HEAD', media.url, timeout=s.timeout)
+        except NETWORK_ERRORS as e:
+            if s.quiet < 2:
+                msg('could not check: {}: {}'.format(media.filename, e))
+            return False
+        if status != 200:
+            return False
+        if remote_infos[wd].has_changed(file, headers):
+            return True
+        remote_infos[wd].set(file, headers)
+        return False
+
+    with ThreadPoolExecutor(max_workers=s.jobs) as executor:
+        changed = [item for item, result in zip(files, executor.map(check, files)) if result]
+
+    # --plan is a dry run
+    if not s.plan:
+        for remote_info in remote_infos.values():
+            remote_info.save()
+    return changed
+
+
+def get_store_file(s: Settings, media: Media):
+    """Return path of media in the content store, or None if not applicable"""
+
+    if s.dedup and media.md5:
+        return s.work_dir / STORE_DIR / (media.md5 + os.path.splitext(media.filename)[1])
+    return None
+
+
+def _link_file(s: Settings, source: Path, dest: Path):
+    """Hard link (or symlink, or copy) a file"""
+
+    if s.quiet < 1:
+        msg('linking: {} -> {}'.format(source, dest))
+    dest.parent.mkdir(exist_ok=True)
+    if dest.is_symlink() or dest.exists():
+        dest.unlink()
+    try:
+        os.link(str(source), str(dest))
+        return
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.relpath(str(source), str(dest.parent)), str(dest))
+    except OSError:
+        shutil.copy2(str(source), str(dest))
 
-        # Download the video
-        if s.quiet < 2:
-            print('[{}/{}]'.format(num + 1, len(download_list)), end=' ', file=stderr)
-        download_media(s, media, wd)
 
+def download_all_subtitles(s: Settings, media_list: List[Media], directory: Path, remote_info: RemoteInfo = None):
+    """Download VTT files from Media
 
-def download_all_subtitles(s: Settings, media_list: List[Media], directory: Path):
-    """Download VTT files from Media"""
+    Files are downloaded in parallel, newest first. With --fix-broken, existing
+    files are only downloaded again if they have changed on the server.
+
+    :param remote_info: headers of the files in directory, if already loaded
+    """
 
     directory.mkdir(exist_ok=True)
 
-    # Get all Media that needs subtitle downloaded
-    queue = set(
-        media for media in media_list
-        if media.subtitle_url
-        # Note: --fix-broken will re-download all subtitle files...
-        if s.overwrite_bad or not (directory / media.subtitle_filename).exists()
-    )
+    # Get all Media that needs subtitle downloaded (only one per file)
+    queue = {}
+    for media in media_list:
+        if media.subtitle_url and media.subtitle_filename not in queue:
+            if s.overwrite_bad or not (directory / media.subtitle_filename).exists():
+                queue[media.subtitle_filename] = media
+    if not queue:
+        return
 
-    for i, media in enumerate(queue):
-        if s.quiet < 2:
-            msg('[{}/{}] downloading: {}'.format(i + 1, len(queue), media.subtitle_filename))
-        download_file(media.subtitle_url, directory / media.subtitle_filename)
+    if remote_info is None:
+        remote_info = RemoteInfo(directory)
+
+    with ThreadPoolExecutor(max_workers=s.jobs) as executor:
+        results = executor.map(lambda m: _download_subtitle(s, m, directory / m.subtitle_filename, remote_info),
+                               queue.values())
+        for i, (filename, result) in enumerate(zip(queue, results)):
+            if result and s.quiet < 2:
+                msg('[{}/{}] {}: {}'.format(i + 1, len(queue), result, filename))
+            elif s.quiet < 1:
+                msg('[{}/{}] unchanged: {}'.format(i + 1, len(queue), filename))
+
+    remote_info.save()
+
+
+def _download_subtitle(s: Settings, media: Media, file: Path, remote_info: RemoteInfo):
+    """Download a subtitle file, unless it has not been changed
+
+    :return: empty string if the file was unchanged, otherwise a message
+    """
+    headers = {}
+    if file.exists():
+        info = remote_info.get(file)
+        if 'ETag' in info:
+            headers['If-None-Match'] = info['ETag']
+        if 'Last-Modified' in info:
+            headers['If-Modified-Since'] = info['Last-Modified']
+
+    def attempt_download(attempt: int):
+        response = http_request('GET', media.subtitle_url, headers, timeout=s.timeout)
+        status = response[0]
+        # Retry server errors like download_with_retry() does
+        if status >= 500 or status in (408, 429):
+            raise HTTPError(media.subtitle_url, status, http.client.responses.get(status, ''), response[1], None)
+        return response
+
+    result = retry_network_errors(s, file.name, attempt_download)
+    if not result:
+        return 'download failed'
+    status, response_headers, body = result
+
+    if status == 304:
+        return ''
+    if status != 200:
+        return 'download failed (HTTP {})'.format(status)
+
+    tmpfile = file.with_name(file.name + '.part')
+    with tmpfile.open('wb') as f:
+        f.write(body)
+    tmpfile.replace(file)
+    remote_info.set(file, response_headers)
+    return 'downloaded'
+
+
+_connections = threading.local()
+
+
+def http_request(method: str, url: str, headers=None, timeout=None):
+    """Make a HTTP request over a persistent connection (one per thread and host)
+
+    Redirects are followed, and the whole body is read into memory.
+
+    :return: status, headers, body
+    """
+    fixtures = get_fixtures()
+    if fixtures and fixtures.replay:
+        return fixtures.load(method, url)
+    start = time.time()
+    original_url = url
+
+    for redirect in range(5):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        pool = _connections.__dict__.setdefault('pool', {})
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+        # A kept-alive connection may have been closed by the server, then try a new one
+        for attempt in range(2):
+            conn = pool.get(key)
+            if not conn:
+                if parts.scheme == 'https':
+                    conn = http.client.HTTPSConnection(parts.netloc, timeout=timeout)
+                else:
+                    conn = http.client.HTTPConnection(parts.netloc, timeout=timeout)
+                pool[key] = conn
+            try:
+                conn.request(method, path, headers=headers or {})
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                del pool[key]
+                if attempt:
+                    raise
+
+        if response.status in (301, 302, 303, 307, 308) and response.headers.get('Location'):
+            url = urllib.parse.urljoin(url, response.headers['Location'])
+            continue
+        if fixtures:
+            fixtures.save(method, original_url, response.status, response.headers, body, time.time() - start)
+        return response.status, response.headers, body
+
+    raise URLError('too many redirects: ' + url)
 
 
 def check_media(s: Settings, media: Media, directory: Path):
@@ -119,12 +981,14 @@ def check_media(s: Settings, media: Media, directory: Path):
     return True
 
 
-def download_media(s: Settings, media: Media, directory: Path):
+def download_media(s: Settings, media: Media, directory: Path, remote_info: RemoteInfo = None, progress=None):
     """Download media file and check it.
 
     :param s: Global settings
     :param media: a Media instance
     :param directory: dir to save the files to
+    :param remote_info: store response headers here
+    :param progress: Progress instance to report to
     :return: True if download was successful
     """
     directory.mkdir(exist_ok=True)
@@ -133,12 +997,18 @@ def download_media(s: Settings, media: Media, directory: Path):
 
     # Check for partially downloaded files
     if tmpfile.exists():
+        headers = None
+        md5 = RunningMD5()
 
         # If file is smaller, resume download
         if media.size and tmpfile.size < media.size:
             if s.quiet < 2:
                 msg('resuming: {} ({})'.format(media.filename, media.name))
-            download_file(media.url, tmpfile, resume=True, rate_limit=s.rate_limit, progress=s.quiet < 1)
+            headers = download_with_retry(s, media.url, tmpfile, resume=True, progress=progress,
+                                          md5=md5 if media.md5 else None)
+            if headers is None:
+                # Keep the partial file for next time
+                return False
 
         # Always validate size and MD5 on resumed downloads
         if media.size and tmpfile.size != media.size:
@@ -146,7 +1016,7 @@ def download_media(s: Settings, media: Media, directory: Path):
                 msg('size mismatch, deleting: {}'.format(tmpfile))
             # Always remove resumed files that have wrong size
             tmpfile.unlink()
-        elif media.md5 and _md5(tmpfile) != media.md5:
+        elif media.md5 and md5.file_digest(tmpfile) != media.md5:
             if s.quiet < 2:
                 msg('checksum mismatch, deleting: {}'.format(tmpfile))
             # Always remove resumed files that are broken
@@ -156,13 +1026,20 @@ def download_media(s: Settings, media: Media, directory: Path):
         else:
             if media.date:
                 tmpfile.set_mtime(media.date)
-            tmpfile.rename(file)
+            tmpfile.replace(file)
+            if remote_info and headers:
+                remote_info.set(file, headers)
+                remote_info.save()
             return True
 
     # Continuing to regular download
     if s.quiet < 2:
         msg('downloading: {} ({})'.format(media.filename, media.name))
-    download_file(media.url, tmpfile, rate_limit=s.rate_limit, progress=s.quiet < 1)
+    md5 = RunningMD5()
+    headers = download_with_retry(s, media.url, tmpfile, progress=progress,
+                                  md5=md5 if s.checksums and media.md5 else None)
+    if headers is None:
+        return False
 
     # Check exist and non-empty
     try:
@@ -177,7 +1054,10 @@ def download_media(s: Settings, media: Media, directory: Path):
     # Set timestamp to date of publishing, move and approve
     if media.date:
         tmpfile.set_mtime(media.date)
-    tmpfile.rename(file)
+    tmpfile.replace(file)
+    if remote_info:
+        remote_info.set(file, headers)
+        remote_info.save()
 
     # Check size (log only)
     if media.size and file.size != media.size:
@@ -185,9 +1065,10 @@ def download_media(s: Settings, media: Media, directory: Path):
             msg('size mismatch: {}'.format(file))
         return False
     # Check MD5 if size was correct (optional, log only)
-    elif s.checksums and media.md5 and _md5(file) != media.md5:
+    elif s.checksums and media.md5 and md5.file_digest(file) != media.md5:
         if s.quiet < 2:
             msg('checksum mismatch: {}'.format(file))
+        return False
 
     return True
 
@@ -214,6 +1095,40 @@ def disk_usage_info(s: Settings):
             exit(1)
 
 
+class RunningMD5:
+    """MD5 of a file that is being downloaded, so it doesn't have to be read again when done"""
+
+    def __init__(self):
+        self.hash = hashlib.md5()
+        self.bytes = 0
+
+    def reset(self):
+        self.__init__()
+
+    def update(self, data):
+        self.hash.update(data)
+        self.bytes += len(data)
+
+    def catch_up(self, file: Path, size: int):
+        """Make sure the hash covers the first bytes of the file, before appending to it"""
+
+        if self.bytes == size:
+            return
+        self.reset()
+        with file.open('rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                self.update(chunk[:size - self.bytes])
+                if self.bytes >= size:
+                    break
+
+    def file_digest(self, file: Path):
+        """Return MD5 of the file (reading it only if the hash doesn't cover all of it)"""
+
+        if self.bytes != file.size:
+            return _md5(file)
+        return self.hash.hexdigest()
+
+
 def _md5(file: Path):
     """Return MD5 of a file."""
 
@@ -224,14 +1139,417 @@ def _md5(file: Path):
     return hash_md5.hexdigest()
 
 
-def download_file(url: str, file: Path, resume=False, rate_limit=0.0, progress=False):
-    """Throttled download with progress bar
+class RateLimiter:
+    """Token bucket that spreads a transfer evenly over time"""
+
+    def __init__(self, rate_limit):
+        """
+        :param rate_limit: MB/s (0 means no limit), or a function that returns it
+        """
+        self.get_rate_limit = rate_limit if callable(rate_limit) else lambda: rate_limit
+        self.rate = self.get_rate_limit() * 1024 * 1024
+        self.tokens = 0.0
+        self.last = self.updated = time.monotonic()
+
+    def chunk_size(self, maximum: int):
+        """Return a read size that gives roughly 20 reads per second"""
+        if not self.rate:
+            return maximum
+        return max(4096, min(maximum, int(self.rate / 20)))
+
+    def consume(self, amount: int):
+        """Take some bytes from the bucket, and sleep if it runs empty"""
+        now = time.monotonic()
+        # The limit may change over time
+        if now - self.updated > 1:
+            self.rate = self.get_rate_limit() * 1024 * 1024
+            self.updated = now
+        if not self.rate:
+            self.last = now
+            return
+        # Never save up more than 1/10 s worth of data, to avoid bursts
+        self.tokens = min(self.tokens + (now - self.last) * self.rate, self.rate / 10)
+        self.last = now
+        self.tokens -= amount
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+class BandwidthShare:
+    """Split the rate limit between all processes on this machine
+
+    Each downloading process touches a file named after its PID in a shared
+    directory, and gets an equal part of the rate limit.
+    """
+
+    def __init__(self):
+        self.directory = cache_dir() / 'bandwidth'
+        self.directory.mkdir(exist_ok=True)
+        self.file = self.directory / str(os.getpid())
+        atexit.register(self.close)
+
+    def split(self, rate: float):
+        """Tell the others we are active, and return our part of the rate"""
+        now = time.time()
+        self.file.touch()
+        active = 0
+        for file in self.directory.iterdir():
+            try:
+                if now - file.mtime < SHARE_TIMEOUT:
+                    active += 1
+                else:
+                    # Process is idle or dead
+                    file.unlink()
+            except OSError:
+                pass
+        return rate / max(active, 1)
+
+    def close(self):
+        try:
+            self.file.unlink()
+        except OSError:
+            pass
+
+
+_bandwidth_share = None
+
+
+class SpaceReservation:
+    """Disk space that downloads in progress are about to use
+
+    Each process writes the device and number of bytes it has left to write
+    to a file named after its PID, so disk_cleanup() in other processes can
+    leave room for it. This is only needed when the space could not be
+    preallocated, because then it doesn't show up as used yet.
+    """
+
+    def __init__(self):
+        self.directory = cache_dir() / 'reserved'
+        self.directory.mkdir(exist_ok=True)
+        self.file = self.directory / str(os.getpid())
+        atexit.register(self.release)
+
+    def reserve(self, directory: Path, size: int):
+        try:
+            with self.file.open('w', encoding='utf-8') as f:
+                json.dump({'device': os.stat(str(directory)).st_dev, 'bytes': size}, f)
+        except OSError:
+            pass
+
+    def release(self):
+        try:
+            self.file.unlink()
+        except OSError:
+            pass
+
+    def others(self, directory: Path):
+        """Return bytes reserved by other processes on the same device"""
+
+        device = os.stat(str(directory)).st_dev
+        total = 0
+        for file in self.directory.iterdir():
+            if file == self.file:
+                continue
+            try:
+                if time.time() - file.mtime > RESERVATION_TIMEOUT or not _pid_exists(int(file.name)):
+                    file.unlink()
+                    continue
+                with file.open(encoding='utf-8') as f:
+                    info = json.load(f)
+                if info['device'] == device:
+                    total += info['bytes']
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        return total
+
+
+def _pid_exists(pid: int):
+    # On Windows os.kill() would terminate the process, so just trust the timeout
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+_space_reservation = None
+
+
+def space_reservation():
+    global _space_reservation
+    if not _space_reservation:
+        _space_reservation = SpaceReservation()
+    return _space_reservation
+
+
+def preallocate(f, file: Path, offset: int, length: int):
+    """Allocate disk space for the rest of a file before writing it, without changing its size
+
+    The size is left alone so a partial download still looks partial.
+
+    :param f: the open file
+    :return: True if the space was allocated, False if the system can't do it
+    :raises OSError: ENOSPC if there is not enough free space
+    """
+    if length <= 0:
+        return True
+    if _fallocate:
+        if _fallocate(f.fileno(), FALLOC_FL_KEEP_SIZE, offset, length) == 0:
+            return True
+        error = ctypes.get_errno()
+        if error == errno.ENOSPC:
+            raise OSError(error, os.strerror(error), str(file))
+        # Not supported by the file system, try the other way
+
+    # At least make sure it fits before starting
+    if shutil.disk_usage(str(file.parent)).free < length:
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), str(file))
+    return False
+
+
+def current_rate_limit(s: Settings):
+    """Return the rate limit in MB/s for this moment, and this process"""
+    global _bandwidth_share
+
+    rate = s.rate_limit
+    if s.rate_schedule:
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        # Before the first entry, the last one from yesterday applies
+        rate = s.rate_schedule[-1][1]
+        for start, scheduled_rate in s.rate_schedule:
+            if start <= minute:
+                rate = scheduled_rate
+
+    if s.shared_rate and rate:
+        if not _bandwidth_share:
+            _bandwidth_share = BandwidthShare()
+        rate = _bandwidth_share.split(rate)
+
+    return rate
+
+
+class Progress:
+    """Progress of the whole download queue
+
+    Shows bytes done, download speed and time left. On a terminal the
+    status line is redrawn every PROGRESS_INTERVAL, otherwise a line is
+    printed every PROGRESS_LOG_INTERVAL. With --progress-json, events are
+    written as JSON lines: "start", "progress" (periodically), "file" (when
+    a file is done or skipped) and "done".
+    """
+
+    def __init__(self, s: Settings, queue: List[Media]):
+        self.show = s.quiet < 1
+        self.tty = stderr.isatty()
+        self.files_total = len(queue)
+        self.files_done = 0
+        self.bytes_total = sum(media.size or 0 for media in queue)
+        # Bytes of finished files, and of the current one
+        self.bytes_done = 0
+        self.file_bytes = 0
+        self.file_total = 0
+
+        self.speed = 0.0
+        self.last_time = time.monotonic()
+        self.last_bytes = 0
+        self.last_render = 0.0
+        self.last_event = 0.0
+        self.line_length = 0
+
+        self.json_file = None
+        if s.progress_json:
+            try:
+                self.json_file = s.progress_json.open('a', encoding='utf-8')
+            except OSError as e:
+                msg('could not open progress file: {}'.format(e))
+        self.event('start')
+
+    @property
+    def current(self):
+        return self.bytes_done + self.file_bytes
+
+    @property
+    def eta(self):
+        """Seconds left, or None if unknown"""
+        if not self.speed:
+            return None
+        return max(self.bytes_total - self.current, 0) / self.speed
+
+    def start_file(self, media: Media):
+        self.file_bytes = 0
+        self.file_total = media.size or 0
+
+    def update(self, done: int, total: int):
+        """Set the number of bytes done of the current file (called for every chunk)"""
+
+        if total and total != self.file_total:
+            # The size in the API was wrong or missing
+            self.bytes_total += total - self.file_total
+            self.file_total = total
+        self.file_bytes = done
+
+        now = time.monotonic()
+        if now - self.last_time >= PROGRESS_INTERVAL:
+            # Bytes can go backwards when a download starts over
+            speed = max(self.current - self.last_bytes, 0) / (now - self.last_time)
+            self.speed = self.speed + PROGRESS_SMOOTHING * (speed - self.speed) if self.speed else speed
+            self.last_time = now
+            self.last_bytes = self.current
+            self.render(now)
+
+    def finish_file(self, media: Media, ok=True):
+        """Count a file as done (or skipped, if not ok)"""
+
+        if ok:
+            self.bytes_done += self.file_total or self.file_bytes
+        else:
+            self.bytes_total -= self.file_total if self.file_total else media.size or 0
+        self.file_bytes = 0
+        self.file_total = 0
+        self.files_done += 1
+        self.last_bytes = self.current
+        self.clear()
+        self.event('file', file=media.filename, ok=ok)
+
+    def render(self, now: float):
+        if self.json_file and now - self.last_event >= PROGRESS_JSON_INTERVAL:
+            self.last_event = now
+            self.event('progress')
+
+        if not self.show:
+            return
+        if self.tty:
+            interval = PROGRESS_INTERVAL
+        else:
+            interval = PROGRESS_LOG_INTERVAL
+        if now - self.last_render < interval:
+            return
+        self.last_render = now
+
+        line = '{:.1f}% of {} MiB, {:.2f} MB/s, {} left'.format(
+            100 * self.current / self.bytes_total if self.bytes_total else 0,
+            self.bytes_total // 1024 ** 2,
+            self.speed / 1000 ** 2,
+            format_duration(self.eta))
+        if self.tty:
+            print('\r' + line.ljust(self.line_length), end='', flush=True, file=stderr)
+            self.line_length = len(line)
+        else:
+            msg('progress: ' + line)
+
+    def clear(self):
+        """Remove the status line from the terminal"""
+
+        if self.line_length:
+            print('\r' + ' ' * self.line_length + '\r', end='', flush=True, file=stderr)
+            self.line_length = 0
+
+    def event(self, kind: str, **kwargs):
+        if not self.json_file:
+            return
+        record = {
+            'event': kind,
+            'time': time.time(),
+            'files_done': self.files_done,
+            'files_total': self.files_total,
+            'bytes_done': self.current,
+            'bytes_total': self.bytes_total,
+            'speed': self.speed,
+            'eta': self.eta
+        }
+        record.update(kwargs)
+        try:
+            self.json_file.write(json.dumps(record) + '\n')
+            self.json_file.flush()
+        except OSError:
+            pass
+
+    def close(self):
+        self.clear()
+        self.event('done')
+        if self.json_file:
+            self.json_file.close()
+            self.json_file = None
+
+
+def format_duration(seconds):
+    """Format seconds like H:MM:SS, or ? if None"""
+
+    if seconds is None:
+        return '?'
+    seconds = int(seconds)
+    return '{}:{:02}:{:02}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def download_with_retry(s: Settings, url: str, file: Path, resume=False, progress: Progress = None,
+                        md5: RunningMD5 = None):
+    """Run download_file() and retry on network errors, resuming where it stopped
+
+    :param progress: Progress instance to report to
+    :param md5: RunningMD5 instance to update with the file contents
+    :return: response headers, or None if download failed
+    """
+    def attempt_download(attempt: int):
+        # Later attempts resume where the last one stopped
+        return download_file(url, file, resume=resume or attempt > 0, rate_limit=lambda: current_rate_limit(s),
+                             progress=progress, timeout=s.timeout, md5=md5)
+
+    return retry_network_errors(s, file.name, attempt_download, progress)
+
+
+def retry_network_errors(s: Settings, name: str, function, progress: Progress = None):
+    """Call function(attempt) and call it again on network errors, with a growing delay
+
+    :param name: what is being downloaded, for messages
+    :param progress: Progress instance to clear before messages
+    :return: result of function, or None if it failed for good
+    """
+    attempt = 0
+    while True:
+        try:
+            return function(attempt)
+        except NETWORK_ERRORS as e:
+            # Client errors won't go away by themselves
+            if isinstance(e, HTTPError) and 400 <= e.code < 500 and e.code not in (408, 429):
+                retry = False
+            else:
+                retry = attempt < s.retries
+            if progress:
+                progress.clear()
+            if s.quiet < 2:
+                msg('download failed: {}: {}'.format(name, e))
+            if not retry:
+                return None
+
+        delay = _retry_delay(attempt)
+        if s.quiet < 2:
+            msg('retrying in {:.0f} s'.format(delay))
+        time.sleep(delay)
+        attempt += 1
+
+
+def _retry_delay(attempt: int):
+    """Exponential backoff with some random jitter"""
+    return min(RETRY_BASE_DELAY * 2 ** attempt, RETRY_MAX_DELAY) * random.uniform(0.5, 1.5)
+
+
+def download_file(url: str, file: Path, resume=False, rate_limit=0.0, progress: Progress = None, timeout=None,
+                  md5: RunningMD5 = None):
+    """Throttled download
 
     :param url: URL to download
     :param file: Output file
     :param resume: Append instead of overwrite
-    :param rate_limit: Rate limit in MB/s
-    :param progress: Show progress bar
+    :param rate_limit: Rate limit in MB/s, or a function that returns it
+    :param progress: Progress instance to report to
+    :param timeout: Seconds before giving up on a connection that doesn't respond
+    :param md5: RunningMD5 instance to update with the file contents
+    :return: response headers
     """
 
     if resume and file.exists():
@@ -241,65 +1559,110 @@ def download_file(url: str, file: Path, resume=False, rate_limit=0.0, progress=F
         file_mode = 'wb'
         done_bytes = 0
 
-    # To be downloaded each second
-    if rate_limit != 0:
-        chunk_size = int(rate_limit * 1024 * 1024)
-    else:
-        # Default chunk size of 1 MB means we do not loose whole file if download gets aborted
-        chunk_size = 1024 * 1024
+    limiter = RateLimiter(rate_limit)
+    # Reuse the same buffer for all reads
+    # It's small so we don't loose much if the download gets aborted
+    buffer = bytearray(256 * 1024)
+    view = memoryview(buffer)
 
     # Ask server to skip the first N bytes
     request = urllib.request.Request(url)
     request.add_header('Range', 'bytes={}-'.format(done_bytes))
 
-    with urllib.request.urlopen(request) as response:
-        if progress:
-            # Get size of download
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        # Server ignored the range, start over
+        if done_bytes and response.status != 206:
+            file_mode = 'wb'
+            done_bytes = 0
+
+        # Get size of download
+        try:
             total_bytes = int(response.headers['content-length']) + done_bytes
-            # Avoid ZeroDivisionError and only print progress bar if we are in a terminal
-            if total_bytes == 0 or not stderr.isatty():
-                progress = False
-
-        with file.open(file_mode) as f:
-            while True:
-                # Print a progress bar
-                if progress:
-                    percent = 100 * (done_bytes / total_bytes)
-                    # Never more than 70 hash signs
-                    bar = '#' * min(70 * done_bytes // total_bytes, 70)
-                    ####----- (padded to 70 chars) NNN.N (padded to 5 chars) %
-                    print('\r{:-<70} {: >5.1f}%'.format(bar, percent), end='', flush=True, file=stderr)
-
-                # Download and write a chunk
-                started = time.time()
-                chunk = response.read(chunk_size)
-                done_bytes += len(chunk)
-                if not chunk:
-                    if progress:
-                        print()  # newline when done
-                    break
-                f.write(chunk)
+        except (TypeError, ValueError):
+            total_bytes = 0
 
-                if rate_limit:
-                    try:
-                        # Every chunk should take 1 second, sleep for the time that's left
-                        time.sleep(1 + started - time.time())
-                    except ValueError:
-                        pass
+        window_start = time.monotonic()
+        window_bytes = 0
 
+        if md5:
+            if done_bytes:
+                md5.catch_up(file, done_bytes)
+            else:
+                md5.reset()
 
-def disk_cleanup(s: Settings, directory: Path, reference_media: Media):
-    """Clean up old videos until there is enough space"""
+        start_bytes = done_bytes
+        reserved = False
+        try:
+            with file.open(file_mode, buffering=WRITE_BUFFER) as f:
+                try:
+                    allocated = not total_bytes or preallocate(f, file, done_bytes, total_bytes - done_bytes)
+                except OSError:
+                    # Don't leave an empty file behind
+                    if not done_bytes:
+                        f.close()
+                        file.unlink()
+                    raise
+                if not allocated:
+                    space_reservation().reserve(file.parent, total_bytes - done_bytes)
+                    reserved = True
+
+                while True:
+                    if progress:
+                        progress.update(done_bytes, total_bytes)
+
+                    # Download and write a chunk
+                    read = response.readinto(view[:limiter.chunk_size(len(buffer))])
+                    if not read:
+                        # Connection closed too early
+                        if done_bytes < total_bytes:
+                            raise http.client.IncompleteRead(b'', total_bytes - done_bytes)
+                        break
+                    done_bytes += read
+                    f.write(view[:read])
+                    if md5:
+                        md5.update(view[:read])
+                    limiter.consume(read)
+
+                    # Stall watchdog
+                    window_bytes += read
+                    elapsed = time.monotonic() - window_start
+                    if elapsed > STALL_WINDOW:
+                        # Don't give up on slow but working connections because of the rate limit
+                        min_rate = min(STALL_MIN_RATE, limiter.rate / 2) if limiter.rate else STALL_MIN_RATE
+                        if window_bytes / elapsed < min_rate:
+                            raise StallError('download stalled')
+                        window_start = time.monotonic()
+                        window_bytes = 0
+        finally:
+            metrics.inc('jwb_index_downloaded_bytes_total', done_bytes - start_bytes)
+            if reserved:
+                space_reservation().release()
+
+    return response.headers
+
+
+def disk_cleanup(s: Settings, directory: Path, reference_media: Media, reserved=0, other_dirs=()):
+    """Clean up old videos until there is enough space
+
+    :raises OSError: ENOSPC if there are no videos left to delete
+    :param reserved: bytes that are about to be written by unfinished transfers
+    :param other_dirs: directories that share the same space (may include directory)
+    """
     assert s.keep_free
-    assert reference_media.size
 
     # As this runs before download, the subdirectory may not exist
-    if not directory.exists():
+    directories = [d for d in dict.fromkeys([directory, *other_dirs]) if d.exists()]
+    if not directories:
         return
+    directory = directories[0]
+
+    # Downloads by other processes that haven't got their space allocated yet
+    reserved += space_reservation().others(directory)
 
     while True:
         space = shutil.disk_usage(str(directory)).free
-        needed = reference_media.size + s.keep_free
+        # If the size is unknown, download_file() will fail if it doesn't fit
+        needed = (reference_media.size or 0) + s.keep_free + reserved
         if space > needed:
             break
         if s.quiet < 1:
@@ -310,12 +1673,11 @@ def disk_cleanup(s: Settings, directory: Path, reference_media: Media):
             raise MissingTimestampError
 
         try:
-            # Get the oldest .mp4 file in the working directory
-            oldest = min((f for f in directory.iterdir() if f.is_mp4()), key=lambda f: f.mtime)
+            # Get the oldest .mp4 file in the working directories
+            oldest = min((f for d in directories for f in d.iterdir() if f.is_mp4()), key=lambda f: f.mtime)
         except ValueError:
-            msg('cannot free more disk space, no videos in {}'.format(directory))
-            exit(1)
-            raise
+            raise OSError(errno.ENOSPC, 'cannot free more disk space, no videos in {}'.format(
+                ', '.join(str(d) for d in directories)))
 
         # If the reference date is older than the oldest file, exit the program.
         if reference_media.date <= oldest.mtime:
@@ -326,38 +1688,294 @@ def disk_cleanup(s: Settings, directory: Path, reference_media: Media):
         # Delete the file and add a "deleted" marker
         if s.quiet < 2:
             msg('removing old video: {}'.format(oldest))
+        if s.dedup:
+            # Other links to the same content would keep it on disk
+            _remove_links(oldest, directories)
+        metrics.inc('jwb_index_evicted_files_total')
+        metrics.inc('jwb_index_evicted_bytes_total', oldest.size)
         oldest.unlink()
 
 
+def _remove_links(file: Path, directories: List[Path]):
+    """Delete all other hard links and symlinks to a file in some directories"""
+
+    target = file.resolve()
+    for d in directories:
+        for other in d.iterdir():
+            if other == file:
+                continue
+            try:
+                if other.resolve() == target or (other.is_file() and other.samefile(file)):
+                    other.unlink()
+            except OSError:
+                pass
+
+
 def copy_files(s: Settings):
     """jwb-index --import
 
-    Fancy copy of files from one directory to another
+    Fancy copy of files from one or more directories to another
+
+    Files with the same name and size as in the destination are skipped.
+    Files with the same size as another file get hashed, to find duplicates
+    under other names. Each unique file is copied from the fastest source.
     """
 
     dest_dir = s.work_dir / s.sub_dir
     dest_dir.mkdir(exist_ok=True)
 
-    # Create a list of all mp4 files to be copied
-    source_files = []
-    for source in s.import_dir.iterdir():
+    manifests = {d: Manifest(d) for d in s.import_dirs + [dest_dir]}
+    hash_cache = HashCache(dest_dir)
+    speeds = {}  # type: Dict[Path, float] # bytes/s
+
+    def get_md5(file: Path):
+        md5 = manifests[file.parent].get_md5(file) or hash_cache.get_md5(file)
+        if not md5:
+            if s.quiet < 1:
+                msg('hashing: {}'.format(file))
+            started = time.time()
+            md5 = _md5(file)
+            speeds[file.parent] = file.size / max(time.time() - started, 0.001)
+            hash_cache.set_md5(file, md5)
+        return md5
+
+    dest_files = {}
+    for file in dest_dir.iterdir():
         try:
-            # Just a simple size check, no checksum etc
-            if source.is_mp4() and source.size != (dest_dir / source.name).size:
-                source_files.append(source)
+            if file.is_mp4():
+                dest_files[file.name] = file
         except OSError:
             pass
 
+    # Create a list of all mp4 files that don't already exist at the destination
+    candidates = []
+    for source_dir in s.import_dirs:
+        for source in source_dir.iterdir():
+            try:
+                if not source.is_mp4():
+                    continue
+                dest = dest_files.get(source.name)
+                if not dest or not _is_same_file(source, manifests[source_dir], dest, manifests[dest_dir]):
+                    candidates.append(source)
+            except OSError:
+                pass
+
+    # Files with a unique size can't be duplicates, so only hash the others
+    sizes = Counter(f.size for f in candidates + list(dest_files.values()))
+
+    def content_id(file: Path):
+        return file.size, get_md5(file) if sizes[file.size] > 1 else ''
+
+    try:
+        present = set(content_id(f) for f in dest_files.values() if sizes[f.size] > 1)
+        duplicates = {}  # type: Dict[tuple, List[Path]]
+        for source in candidates:
+            key = content_id(source)
+            if key not in present:
+                duplicates.setdefault(key, []).append(source)
+    finally:
+        hash_cache.save()
+
+    # Pick the fastest source for each file
+    source_files = []
+    for files in duplicates.values():
+        if len(files) > 1:
+            for directory in set(f.parent for f in files):
+                if directory not in speeds:
+                    speeds[directory] = _read_speed(directory)
+            files.sort(key=lambda f: speeds[f.parent], reverse=True)
+        source_files.append(files[0])
+
+    # Different files with the same name would be copied to the same place, use the newest
+    by_name = {}  # type: Dict[str, List[Path]]
+    for file in source_files:
+        by_name.setdefault(file.name, []).append(file)
+    source_files = []
+    for name, files in by_name.items():
+        files.sort(key=lambda x: x.mtime, reverse=True)
+        if len(files) > 1 and s.quiet < 2:
+            msg('warning: different files named {}, using {}'.format(name, files[0]))
+        source_files.append(files[0])
+
     # Newest file first
-    source_files.sort(key=lambda x: x.date, reverse=True)
+    source_files.sort(key=lambda x: x.mtime, reverse=True)
+
+    # Hard links take no space, so there is nothing to clean up for
+    linking = {d: _can_link(d, dest_dir) for d in s.import_dirs}
+    if any(linking.values()) and s.quiet < 1:
+        msg('note: source is on the same file system, creating hard links')
 
     total = len(source_files)
-    for source_file in source_files:
-        if s.keep_free > 0:
-            disk_cleanup(s, directory=dest_dir, reference_media=source_file)
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=s.jobs) as executor:
+        try:
+            for num, source_file in enumerate(source_files):
+                # Wait for a free worker, so that disk clean up happens in the right order
+                while len(in_flight) >= s.jobs:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    _finish_imports(s, done, in_flight, manifests[dest_dir])
+
+                if s.keep_free > 0 and not linking[source_file.parent]:
+                    reference = Media()
+                    reference.size = source_file.size
+                    reference.date = source_file.mtime
+                    try:
+                        disk_cleanup(s, dest_dir, reference, reserved=sum(f.size for f, _ in in_flight.values()))
+                    except DiskLimitReached:
+                        break
+                    except OSError as e:
+                        if e.errno != errno.ENOSPC:
+                            raise
+                        msg(e.strerror)
+                        break
 
-        if s.quiet < 1:
-            i = source_files.index(source_file)
-            msg('copying [{}/{}]: {}'.format(i + 1, total, source_file.name))
+                if s.quiet < 1:
+                    msg('copying [{}/{}]: {}'.format(num + 1, total, source_file))
+
+                future = executor.submit(_import_file, source_file, dest_dir / source_file.name,
+                                         linking[source_file.parent])
+                in_flight[future] = source_file, (manifests[source_file.parent].get_md5(source_file)
+                                                  or hash_cache.get_md5(source_file))
+
+            _finish_imports(s, list(in_flight), in_flight, manifests[dest_dir])
+        finally:
+            manifests[dest_dir].save()
+
+
+def _is_same_file(source: Path, source_manifest: Manifest, dest: Path, dest_manifest: Manifest):
+    """Compare size and (if known) MD5 of two files"""
+
+    try:
+        if source.size != dest.size:
+            return False
+    except FileNotFoundError:
+        return False
+    source_md5 = source_manifest.get_md5(source)
+    dest_md5 = dest_manifest.get_md5(dest)
+    return not (source_md5 and dest_md5) or source_md5 == dest_md5
+
+
+def _finish_imports(s: Settings, futures, in_flight: dict, manifest: Manifest):
+    """Wait for imports to finish and record their checksums
+
+    :param in_flight: dict with future: (source file, MD5)
+    """
+    for future in futures:
+        source, md5 = in_flight.pop(future)
+        try:
+            future.result()
+        except OSError as e:
+            if s.quiet < 2:
+                msg('copying failed: {}: {}'.format(source, e))
+            continue
+        if md5:
+            manifest.set_md5(manifest.file.parent / source.name, md5)
+
+
+def _read_speed(directory: Path):
+    """Measure how fast files can be read from a directory, in bytes/s"""
+
+    try:
+        # Read from the middle of the largest file, which is least likely to be cached
+        file = max((f for f in directory.iterdir() if f.is_mp4()), key=lambda f: f.size)
+        buffer = bytearray(1024 * 1024)
+        done = 0
+        with file.open('rb', buffering=0) as f:
+            f.seek(file.size // 2)
+            started = time.time()
+            while done < 8 * len(buffer):
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                done += n
+        return done / max(time.time() - started, 0.001)
+    except (OSError, ValueError):
+        return 0.0
+
+
+def _can_link(source_dir: Path, dest_dir: Path):
+    """True if hard links can be created from one directory to another
+
+    Only the destination is written to, the source may be read-only.
+    """
+    if source_dir.stat().st_dev != dest_dir.stat().st_dev:
+        return False
+    source_file = next((f for f in source_dir.iterdir() if f.is_file()), None)
+    if not source_file:
+        return False
+    test_link = dest_dir / '.link-test'
+    try:
+        if test_link.exists():
+            test_link.unlink()
+        os.link(str(source_file), str(test_link))
+        return True
+    except OSError:
+        return False
+    finally:
+        try:
+            test_link.unlink()
+        except OSError:
+            pass
+
+
+def _import_file(source: Path, dest: Path, link=False):
+    """Link or copy a file, with the fastest method available"""
+
+    tmpfile = dest.with_name(dest.name + '.part')
+    if tmpfile.exists():
+        tmpfile.unlink()
+
+    if link:
+        os.link(str(source), str(tmpfile))
+    else:
+        with source.open('rb') as fsrc, tmpfile.open('wb') as fdst:
+            _copy_data(fsrc, fdst)
+        shutil.copystat(str(source), str(tmpfile))
+
+    tmpfile.replace(dest)
+
+
+def _copy_data(fsrc, fdst):
+    """Copy data between two open files, letting the kernel do the work if possible"""
+
+    # Reflink (copy-on-write clone)
+    if fcntl:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+
+    size = os.fstat(fsrc.fileno()).st_size
+    chunk_size = 64 * 1024 * 1024
+
+    # In-kernel copy (Linux, Python 3.8+)
+    if hasattr(os, 'copy_file_range'):
+        try:
+            done = 0
+            while done < size:
+                sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(), chunk_size, done, done)
+                if sent == 0:
+                    break
+                done += sent
+            return
+        except OSError:
+            if done > 0:
+                raise
+
+    # In-kernel copy (Linux)
+    if hasattr(os, 'sendfile'):
+        try:
+            done = 0
+            while done < size:
+                sent = os.sendfile(fdst.fileno(), fsrc.fileno(), done, chunk_size)
+                if sent == 0:
+                    break
+                done += sent
+            return
+        except OSError:
+            if done > 0:
+                raise
 
-        shutil.copy2(source_file.path, dest_dir / source_file.name)
+    # Plain old copy
+    shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
@@ -1,39 +1,316 @@
 import argparse
+import copy
 import json
+import os
+import random
+import shutil
+import signal
+import threading
 import time
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
-from jwlib.common import Path, Settings, action_factory, msg
-from jwlib.download import copy_files, download_all, disk_usage_info
+from jwlib.common import Path, Settings, action_factory, cache_dir, get_fixtures, metrics, msg, open_url, use_fixtures
+from jwlib.download import NETWORK_ERRORS, DownloadPlan, copy_files, download_all_languages, download_unfinished, \
+    disk_usage_info
 from jwlib.output import create_output
-from jwlib.parse import parse_broadcasting, get_categories
+from jwlib.parse import Media, parse_broadcasting, get_categories, get_category_filter
 
 
-def get_jwb_languages():
-    """Returns [ {'code': str, 'name': str}, ... ]"""
+# Seconds before the cached language list gets refreshed
+LANGUAGE_CACHE_TTL = 7 * 24 * 60 * 60
+
+_languages = None
+
 
+def fetch_jwb_languages():
+    """Download language list, save it to cache and return it
+
+    With --record or --replay the cache is left alone.
+    """
     url = 'https://data.jw-api.org/mediator/v1/languages/E/web?clientType=www'
-    with urllib.request.urlopen(url) as response:
-        return json.loads(response.read().decode('utf-8'))['languages']
+    with open_url(url) as response:
+        languages = {l['code']: l['name'] for l in json.loads(response.read().decode('utf-8'))['languages']}
+    if get_fixtures():
+        return languages
+
+    file = cache_dir() / 'languages.json'
+    tmpfile = cache_dir() / 'languages.json.part'
+    with tmpfile.open('w', encoding='utf-8') as f:
+        json.dump(languages, f)
+    tmpfile.replace(file)
+    return languages
+
+
+def _refresh_jwb_languages():
+    global _languages
+    try:
+        _languages = fetch_jwb_languages()
+    except NETWORK_ERRORS + (OSError, ValueError):
+        pass
+
+
+def get_jwb_languages():
+    """Returns {code: name, ...}
+
+    The list is cached on disk. An outdated cache is used as is, and refreshed in the background.
+    """
+    global _languages
+    if _languages is None and get_fixtures():
+        _languages = fetch_jwb_languages()
+    elif _languages is None:
+        file = cache_dir() / 'languages.json'
+        try:
+            with file.open(encoding='utf-8') as f:
+                _languages = json.load(f)
+        except (OSError, ValueError):
+            _languages = fetch_jwb_languages()
+        else:
+            if time.time() - file.mtime > LANGUAGE_CACHE_TTL:
+                threading.Thread(target=_refresh_jwb_languages, daemon=True).start()
+    return _languages
 
 
 def verify_language(code):
     if code != 'E':
-        for l in get_jwb_languages():
-            if l['code'] == code:
-                break
-        else:
+        try:
+            languages = get_jwb_languages()
+        except NETWORK_ERRORS + (ValueError,) as e:
+            msg('warning: could not verify language code ({})'.format(e))
+            return code
+        if code not in languages:
             raise ValueError(code + ': invalid language code')
     return code
 
 
+def verify_languages(string):
+    """Turn comma separated language codes into a list"""
+
+    return [verify_language(code) for code in string.split(',')]
+
+
+def parse_schedule(string):
+    """Turn 'HH:MM=RATE,...' into a sorted list of (minute of day, rate)"""
+
+    schedule = []
+    for entry in string.split(','):
+        start, rate = entry.split('=')
+        hour, minute = start.split(':')
+        schedule.append((int(hour) * 60 + int(minute), float(rate)))
+    return sorted(schedule)
+
+
 def print_language(x):
+    try:
+        languages = get_jwb_languages()
+    except NETWORK_ERRORS + (ValueError,) as e:
+        msg('could not get language list: {}'.format(e))
+        exit(1)
+        raise
     msg('language codes:')
-    for l in get_jwb_languages():
-        msg('{:>3}  {:<}'.format(l['code'], l['name']))
+    for code, name in sorted(languages.items()):
+        msg('{:>3}  {:<}'.format(code, name))
     exit()
 
 
+def split_languages(s: Settings):
+    """Return a list with a copy of the settings for each language"""
+
+    if len(s.languages) == 1:
+        return [s]
+
+    result = []
+    for lang in s.languages:
+        ls = copy.copy(s)
+        ls.lang = lang
+        # Languages must never share directory
+        ls.sub_dir = 'jwb-' + lang
+        if s.output_filename:
+            name, ext = os.path.splitext(s.output_filename)
+            ls.output_filename = '{}-{}{}'.format(name, lang, ext)
+        result.append(ls)
+    return result
+
+
+def index(settings_list):
+    """Index all languages at the same time
+
+    :return: list of (settings, data)
+    """
+    start = time.monotonic()
+    if len(settings_list) == 1:
+        result = [(settings_list[0], parse_broadcasting(settings_list[0]))]
+    else:
+        with ThreadPoolExecutor(max_workers=len(settings_list)) as executor:
+            result = list(zip(settings_list, executor.map(parse_broadcasting, settings_list)))
+    metrics.set('jwb_index_phase_seconds', time.monotonic() - start, phase='index')
+    return result
+
+
+def process(jobs, output_jobs=None):
+    """Download and create output
+
+    :param jobs: list of (settings, data)
+    :param output_jobs: use this for output instead (if set)
+    """
+    s = jobs[0][0]
+    if s.download or s.download_subtitles:
+        start = time.monotonic()
+        download_all_languages(jobs)
+        metrics.set('jwb_index_phase_seconds', time.monotonic() - start, phase='download')
+
+    if s.mode:
+        start = time.monotonic()
+        for ls, data in output_jobs or jobs:
+            create_output(ls, data)
+        metrics.set('jwb_index_phase_seconds', time.monotonic() - start, phase='output')
+
+    write_metrics(s)
+
+
+def write_metrics(s: Settings):
+    """Write --metrics file"""
+
+    if not s.metrics_file:
+        return
+    metrics.set('jwb_index_last_run_timestamp_seconds', time.time())
+    try:
+        metrics.set('jwb_index_free_bytes', shutil.disk_usage(str(s.work_dir)).free)
+    except OSError:
+        pass
+    metrics.write(s.metrics_file)
+
+
+def print_plan(jobs):
+    """Show what --download would do, without doing it"""
+
+    s = jobs[0][0]
+    plan = DownloadPlan(jobs)
+    plan.scan()
+    result = plan.estimate()
+
+    if s.plan_json:
+        if str(s.plan_json) == '-':
+            print(json.dumps(result, indent=2))
+            return
+        with s.plan_json.open('w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+    for entry in result['delete']:
+        print('delete:   {}'.format(entry['file']))
+    for entry in result['links']:
+        print('link:     {}'.format(entry['link']))
+    for entry in result['downloads']:
+        print('download: {} ({} MiB)'.format(entry['file'], entry['size'] // 1024 ** 2))
+    for entry in result['skipped']:
+        print('skip:     {}'.format(entry['file']))
+
+    msg('{} files to download, {} MiB'.format(len(result['downloads']), result['total_bytes'] // 1024 ** 2))
+    if result['delete']:
+        msg('{} files to delete, {} MiB'.format(len(result['delete']), result['delete_bytes'] // 1024 ** 2))
+    if result['skipped']:
+        msg('{} files will not fit on disk'.format(len(result['skipped'])))
+    if result['eta'] is not None:
+        msg('estimated time: {}:{:02}'.format(int(result['eta'] // 3600), int(result['eta'] % 3600 // 60)))
+    else:
+        msg('estimated time: unknown (no rate limit or previous download speed)')
+
+
+def remove_media(data, urls):
+    """Return a copy of the category list without some media
+
+    :param urls: set of URLs of media to leave out
+    """
+    result = []
+    for category in data:
+        category = copy.copy(category)
+        category.contents = [x for x in category.contents if not (isinstance(x, Media) and x.url in urls)]
+        result.append(category)
+    return result
+
+
+def is_handled(s: Settings, media: Media):
+    """True if there is nothing more to do with a media in daemon mode"""
+
+    wd = s.work_dir / s.sub_dir
+    if s.download and not (wd / media.filename).exists():
+        return False
+    if s.download_subtitles and media.subtitle_url and not (wd / media.subtitle_filename).exists():
+        return False
+    return True
+
+
+def write_status(s: Settings, status: dict):
+    """Write daemon status to a JSON file"""
+
+    if not s.status_file:
+        return
+    tmpfile = s.status_file.with_name(s.status_file.name + '.part')
+    try:
+        with tmpfile.open('w', encoding='utf-8') as f:
+            json.dump(status, f, indent=2)
+        tmpfile.replace(s.status_file)
+    except OSError as e:
+        msg('could not write status: {}'.format(e))
+
+
+def run_daemon(settings_list):
+    """Index, download and create output over and over
+
+    Media that has already been handled in a previous round is left out,
+    so only new media gets checked, downloaded and added to the output.
+    """
+
+    def handler(signal, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, handler)
+
+    s = settings_list[0]
+    # Set of URLs for each language
+    handled = {ls.lang: set() for ls in settings_list}
+    status = {'pid': os.getpid(), 'state': 'starting', 'rounds': 0, 'failed_rounds': 0, 'last_error': None}
+
+    try:
+        while True:
+            status.update(state='running', last_start=time.time())
+            write_status(s, status)
+            try:
+                jobs = index(settings_list)
+                new_jobs = [(ls, remove_media(data, handled[ls.lang])) for ls, data in jobs]
+                # Files that are not appended to must be written with everything
+                process(new_jobs, output_jobs=None if s.append else jobs)
+                for ls, data in new_jobs:
+                    handled[ls.lang].update(media.url for category in data for media in category.contents
+                                            if isinstance(media, Media) and is_handled(ls, media))
+                status['last_error'] = None
+            except Exception as e:
+                # A failed round must not stop the daemon, whatever went wrong
+                msg('error: {}: {}'.format(type(e).__name__, e))
+                status['failed_rounds'] += 1
+                status['last_error'] = str(e)
+                metrics.inc('jwb_index_failed_rounds_total')
+
+            if status['last_error']:
+                try:
+                    write_metrics(s)
+                except Exception as e:
+                    msg('could not write metrics: {}'.format(e))
+
+            # Spread out the load a little
+            delay = s.interval * 60 * random.uniform(0.9, 1.1)
+            status['rounds'] += 1
+            status.update(state='idle', last_end=time.time(), next_start=time.time() + delay)
+            write_status(s, status)
+            if s.quiet < 1:
+                msg('next update at {}'.format(time.strftime('%H:%M', time.localtime(status['next_start']))))
+            time.sleep(delay)
+
+    except KeyboardInterrupt:
+        msg('stopping')
+        status['state'] = 'stopped'
+        write_status(s, status)
+
+
 def main():
     usage = '''
       %(prog)s [options] [DIR]
@@ -50,10 +327,16 @@ def main():
     p.add_argument('--category', '-c', dest='include_categories', metavar='CODE',
                    action=action_factory(lambda x: x.split(',')),
                    help='comma separated list of categories to index')
+    p.add_argument('--check-remote', action='store_true',
+                   help='ask the server if existing files have changed, and re-download them')
     p.add_argument('--checksum', action='store_true', dest='checksums',
                    help="validate MD5 checksums")
     p.add_argument('--clean-symlinks', action='store_true', dest='clean_all_symlinks',
                    help='remove all old symlinks (mode=filesystem)')
+    p.add_argument('--daemon', action='store_true',
+                   help='keep running and update every --interval minutes')
+    p.add_argument('--dedup', action='store_true',
+                   help='link files with the same MD5 checksum instead of downloading them again')
     p.add_argument('--download', '-d', action='store_true',
                    help='download media files')
     p.add_argument('--download-subtitles', action='store_true',
@@ -61,8 +344,12 @@ def main():
     p.add_argument('--exclude', metavar='CODE', dest='exclude_categories',
                    action=action_factory(lambda x: x.split(',')),
                    help='comma separated list of categories to skip (sub-categories will also be skipped)')
+    p.add_argument('--fit', type=int, metavar='N', dest='fit_items',
+                   help='lower the quality of older videos until the N newest fit on disk (see --free)')
     p.add_argument('--fix-broken', action='store_true', dest='overwrite_bad',
                    help='check existing files and re-download them if they are broken')
+    p.add_argument('--filter-subtree', action='store_true',
+                   help='with --latest, also include sub categories of sub categories')
     p.add_argument('--free', type=int, metavar='MiB', dest='keep_free',
                    action=action_factory(lambda x: x * 1024 * 1024),  # MiB to B
                    help='disk space in MiB to keep free (warning: deletes old MP4 files, use separate folder!)')
@@ -70,40 +357,91 @@ def main():
                    help='save downloads with human readable names')
     p.add_argument('--hard-subtitles', action='store_true',
                    help='prefer videos with hard-coded subtitles')
-    p.add_argument('--import', dest='import_dir', metavar='DIR',
-                   help='import of media files from this directory (offline)')
-    p.add_argument('--lang', '-l', action=action_factory(verify_language),
-                   help='language code')
+    p.add_argument('--import', dest='import_dirs', metavar='DIR', type=Path, action='append',
+                   help='import of media files from this directory (offline, can be used multiple times)')
+    p.add_argument('--interval', type=int, metavar='MIN',
+                   help='minutes between updates in daemon mode (default = 60)')
+    p.add_argument('--jobs', '-j', type=int, metavar='N',
+                   help='number of files to process in parallel (default = 4)')
+    p.add_argument('--lang', '-l', dest='languages', action=action_factory(verify_languages),
+                   help='language code (or comma separated list of codes)')
     p.add_argument('--languages', '-L', nargs=0, action=action_factory(print_language),
                    help='display a list of valid language codes')
     p.add_argument('--latest', action='store_true',
                    help='index the "Latest Videos" category only')
     p.add_argument('--limit-rate', '-R', metavar='RATE', type=float, dest='rate_limit',
                    help='maximum download rate, in megabytes/s (default = 1 MB/s, 0 = no limit)')
+    p.add_argument('--limit-schedule', metavar='HH:MM=RATE,...', dest='rate_schedule',
+                   action=action_factory(parse_schedule),
+                   help='change the rate limit at these times of day (overrides --limit-rate)')
     p.add_argument('--list-categories', '-C', nargs='?', const='VideoOnDemand', metavar='CODE', dest='print_category',
                    help='print a list of (sub) category names')
+    p.add_argument('--max-category-items', type=int, metavar='N',
+                   help='only use the N first media of each category (according to --sort, or newest for downloads)')
+    p.add_argument('--max-items', type=int, metavar='N',
+                   help='only use the N first media (according to --sort, or newest for downloads)')
+    p.add_argument('--metrics', metavar='FILE', type=Path, dest='metrics_file',
+                   help='write Prometheus metrics to this file after each run (for the textfile collector)')
     p.add_argument('--mode', '-m',
-                   choices=['filesystem', 'html', 'html_tree', 'm3u', 'm3u_multi', 'm3u_tree', 'run', 'stdout', 'txt'],
+                   choices=['filesystem', 'html', 'html_pages', 'html_tree', 'jsonl', 'm3u', 'm3u_multi', 'm3u_tree',
+                            'run', 'sqlite', 'stdout', 'txt'],
                    help='output mode (see wiki)')
     p.add_argument('--no-warning', dest='warning', action='store_false',
                    help='do not warn when space limit seems wrong')
+    p.add_argument('--plan', action='store_true',
+                   help='show what would be downloaded and deleted, without doing it')
+    p.add_argument('--plan-json', metavar='FILE', type=Path,
+                   help='with --plan, also write the plan as JSON to this file (- for stdout)')
+    p.add_argument('--priority', metavar='CODE', dest='priority_categories',
+                   action=action_factory(lambda x: x.split(',')),
+                   help='comma separated list of categories to download first (with --queue=priority)')
+    p.add_argument('--progress-json', metavar='FILE', type=Path,
+                   help='append download progress events as JSON lines to this file')
     p.add_argument('--quality', '-Q', type=int,
                    choices=[240, 360, 480, 720],
                    help='maximum video quality')
     p.add_argument('--quiet', '-q', action='count',
                    help='Less info, can be used multiple times')
+    p.add_argument('--queue', dest='queue_order',
+                   choices=['newest', 'smallest', 'round-robin', 'priority'],
+                   help='download order: newest first (default), smallest files first, '
+                        'one from each category at a time, or --priority and home categories first')
+    p.add_argument('--record', metavar='DIR', type=Path, dest='record_dir',
+                   help='save all API responses in this directory, for --replay')
+    p.add_argument('--replay', metavar='DIR', type=Path, dest='replay_dir',
+                   help='use API responses saved by --record instead of the network')
+    p.add_argument('--retries', type=int, metavar='N',
+                   help='number of times to retry a failed download (default = 5)')
+    p.add_argument('--shared-limit', action='store_true', dest='shared_rate',
+                   help='split the rate limit between all jwb-index processes on this machine')
     p.add_argument('--since', metavar='YYYY-MM-DD', dest='min_date',
                    action=action_factory(lambda x: time.mktime(time.strptime(x, '%Y-%m-%d'))),
                    help='only index media newer than this date')
+    p.add_argument('--status-file', metavar='FILE', type=Path,
+                   help='write daemon status as JSON to this file')
     p.add_argument('--sort',
                    choices=['newest', 'oldest', 'name', 'random'],
                    help='sort output')
+    p.add_argument('--timeout', type=int, metavar='SEC',
+                   help='give up on connections that do not respond within this time (default = 30)')
     p.add_argument('--update', action='store_true',
                    help='update existing categories with the latest videos (implies --append --latest --sort=newest)')
     p.add_argument('positional_arguments', nargs='*', metavar='DIR|FILE|COMMAND',
                    help='where to send output (depends on mode)')
 
+    # Start recording before --lang fetches the language list
+    # (a separate parser, because parsing runs the --lang action)
+    pre_parser = argparse.ArgumentParser(add_help=False)
+    pre_parser.add_argument('--record', type=Path, dest='record_dir')
+    pre_parser.add_argument('--replay', type=Path, dest='replay_dir')
+    pre, _ = pre_parser.parse_known_args()
+    if pre.replay_dir:
+        use_fixtures(pre.replay_dir, replay=True)
+    elif pre.record_dir:
+        use_fixtures(pre.record_dir)
+
     s = p.parse_args(namespace=Settings())
+    s.lang = s.languages[0]
 
     # Quick print of categories list
     if s.print_category:
@@ -111,24 +449,25 @@ def main():
         exit()
 
     # Required arguments
-    if not (s.mode or s.download or s.download_subtitles or s.import_dir):
+    if not (s.mode or s.download or s.download_subtitles or s.import_dirs or s.plan or s.plan_json):
         msg('please use --mode or --download')
         exit(1)
 
     # Implicit arguments
+    if s.plan_json:
+        s.plan = True
+    if s.plan:
+        s.download = True
     if s.update:
         s.append = True
         s.latest = True
         if not s.sort:
             s.sort = 'newest'
     if s.latest:
-        for key in s.include_categories:
-            if key != 'VideoOnDemand':
-                # Add key and its sub categories to the filter
-                s.filter_categories.append(key)
-                if s.quiet < 1:
-                    msg('preparing filter: ' + key)
-                s.filter_categories += get_categories(s, key)
+        # Add keys and their sub categories to the filter
+        keys = [key for key in s.include_categories if key != 'VideoOnDemand']
+        if keys:
+            s.filter_categories = get_category_filter(s, keys, subtree=s.filter_subtree)
         s.include_categories = ['LatestVideos']
 
     # Handle positional arguments depending on mode
@@ -142,7 +481,7 @@ def main():
     elif len(s.positional_arguments) == 1:
         path = Path(s.positional_arguments[0])
         # FILE
-        if s.mode in ('txt', 'm3u', 'html') and not path.is_dir():
+        if s.mode in ('txt', 'm3u', 'html', 'html_pages', 'jsonl', 'sqlite') and not path.is_dir():
             s.output_filename = path.name
             s.work_dir = path.parent
         # DIR
@@ -161,12 +500,12 @@ def main():
     if s.mode not in ('', 'stdout'):
         s.sub_dir = 'jwb-' + s.lang
 
-    # Warning if disk space is already below limit
-    if (s.download or s.import_dir) and s.keep_free > 0:
+    # Warning if disk space is already below limit (--plan shows what would be deleted instead)
+    if (s.download and not s.plan or s.import_dirs) and s.keep_free > 0:
         disk_usage_info(s)
 
     # Offline import (stops here)
-    if s.import_dir:
+    if s.import_dirs:
         copy_files(s)
         exit()
 
@@ -181,19 +520,27 @@ def main():
 
     # Some heads-up
     if s.quiet < 1:
-        if s.download and s.rate_limit:
+        if s.download and (s.rate_limit or s.rate_schedule):
             msg('note: download rate limit is active')
         if s.safe_filenames:
             msg('note: using NTFS/FAT compatible file names')
 
-    # Do the indexing
-    data = parse_broadcasting(s)
+    settings_list = split_languages(s)
 
-    if s.download or s.download_subtitles:
-        download_all(s, data)
+    if s.plan:
+        print_plan(index(settings_list))
+        return
 
-    if s.mode:
-        create_output(s, data)
+    # Downloads of an interrupted run don't need to wait for indexing
+    if s.download:
+        download_unfinished(settings_list)
+
+    if s.daemon:
+        run_daemon(settings_list)
+        return
+
+    # Do the indexing
+    process(index(settings_list))
 
 
 if __name__ == '__main__':
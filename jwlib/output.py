@@ -1,12 +1,77 @@
+import heapq
 import html
+import json
 import subprocess
 from os.path import relpath
-from random import shuffle
+from random import sample, shuffle
 from typing import List, Type
 
 from .parse import Category, Media, CategoryNameError
 from .common import Path, Settings, msg
 
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# Number of media per page in --mode=html_pages
+PAGE_SIZE = 100
+
+# Templates for --mode=html_pages
+# The catalog is loaded as a script (only when searching) because browsers don't allow fetch() on file:// URLs
+PAGE_HEAD = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"/><meta name="viewport" content="width=device-width"/><title>{title}</title>
+<style>body{{font-family:sans-serif;margin:1em}}li{{margin:.3em 0}}.nav a{{margin-right:1em}}</style>
+</head><body>
+<h1>{title}</h1>
+<input id="filter" type="search" placeholder="{placeholder}" autofocus/>
+'''
+PAGE_FILTER_SCRIPT = '''<script>
+document.getElementById("filter").oninput = function () {
+  var q = this.value.toLowerCase();
+  document.querySelectorAll("#list li").forEach(function (li) {
+    li.hidden = li.textContent.toLowerCase().indexOf(q) < 0;
+  });
+};
+</script>
+'''
+INDEX_SEARCH_SCRIPT = '''<ul id="results"></ul>
+<script>
+var catalogUrl = {catalog_url}, catalog = null, loading = false, input = document.getElementById("filter");
+function jwbCatalog(data) {{ catalog = data; search(); }}
+function search() {{
+  var q = input.value.toLowerCase(), results = document.getElementById("results");
+  document.getElementById("list").hidden = q !== "";
+  results.innerHTML = "";
+  if (!q) return;
+  if (!catalog) {{
+    if (!loading) {{
+      loading = true;
+      var script = document.createElement("script");
+      script.src = catalogUrl;
+      document.head.appendChild(script);
+    }}
+    return;
+  }}
+  var count = 0;
+  for (var url in catalog.media) {{
+    var m = catalog.media[url];
+    if (m.n.toLowerCase().indexOf(q) < 0) continue;
+    var li = document.createElement("li"), a = document.createElement("a");
+    // Downloaded files are relative to the pages, the rest are URLs
+    a.href = m.l ? catalog.base + m.s : m.s;
+    a.textContent = m.n;
+    li.appendChild(a);
+    results.appendChild(li);
+    if (++count >= {limit}) break;
+  }}
+}}
+input.oninput = search;
+</script>
+'''
+PAGE_END = '''</body></html>
+'''
+
 
 class FileParseError(Exception):
     pass
@@ -217,17 +282,193 @@ class CommandWriter(AbstractOutputWriter):
             self.queue = self.queue[300:]
 
 
-def sort_media(media_list: List[Media], sort: str):
-    """Sort a list of Media objects in place"""
+class CatalogWriter:
+    """Base class for machine readable catalogs
+
+    Unlike the playlist writers nothing is queued, every record is written
+    as soon as it is added. With --append, records that are already in the
+    catalog are skipped (media by URL, categories by key), otherwise the
+    catalog is written to a temporary file that replaces the old one on close().
+    """
+    ext = ''
+
+    def __init__(self, s: Settings, file: Path):
+        self.quiet = s.quiet
+        self.append = s.append
+        self.file = file
+        self.tmpfile = file if self.append else file.with_name(file.name + '.part')
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+
+        if self.quiet < 1:
+            if self.append and self.file.exists():
+                msg('updating: {}'.format(self.file))
+            else:
+                msg('creating: {}'.format(self.file))
+
+    def add_category(self, category: Category):
+        raise NotImplementedError
+
+    def add_media(self, media: Media, category: Category, source: str):
+        """
+        :param category: the category the media was found in
+        :param source: local path relative to the catalog, or empty string
+        """
+        raise NotImplementedError
+
+    def close(self):
+        if self.tmpfile != self.file:
+            self.tmpfile.replace(self.file)
+
+
+class JsonlWriter(CatalogWriter):
+    """One JSON object per line, with a "type" of either "category" or "media" """
+    ext = '.jsonl'
+
+    def __init__(self, s: Settings, file: Path):
+        super().__init__(s, file)
+
+        # Keys of categories and URLs of media
+        self.history = set()
+        if self.append:
+            self.load_existing()
+        self.fd = self.tmpfile.open('a' if self.append else 'w', encoding='utf-8')
+
+    def load_existing(self):
+        """Read keys and URLs from the existing file, one line at a time"""
+
+        try:
+            with self.file.open(encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                        self.history.add(record['url'] if record['type'] == 'media' else record['key'])
+                    except (ValueError, KeyError, TypeError):
+                        raise FileParseError
+        except OSError:
+            pass
+
+    def write(self, identifier: str, record: dict):
+        if identifier in self.history:
+            return
+        self.history.add(identifier)
+        self.fd.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def add_category(self, category):
+        self.write(category.key, {
+            'type': 'category',
+            'key': category.key,
+            'name': category.name,
+            'home': category.home,
+            'subcategories': [c.key for c in category.contents if isinstance(c, Category)],
+            'media': [m.url for m in category.contents if isinstance(m, Media)]
+        })
+
+    def add_media(self, media, category, source):
+        self.write(media.url, {
+            'type': 'media',
+            'url': media.url,
+            'name': media.name,
+            'filename': media.filename,
+            'size': media.size,
+            'md5': media.md5,
+            'date': media.date,
+            'duration': media.duration,
+            'subtitle_url': media.subtitle_url,
+            'category': category.key,
+            'file': source
+        })
+
+    def close(self):
+        self.fd.close()
+        super().close()
+
+
+class SqliteWriter(CatalogWriter):
+    """SQLite database with a table for media, categories and the relations between them"""
+    ext = '.db'
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS category (
+            key TEXT PRIMARY KEY, name TEXT, home INTEGER);
+        CREATE TABLE IF NOT EXISTS subcategory (
+            parent TEXT, child TEXT, PRIMARY KEY (parent, child));
+        CREATE TABLE IF NOT EXISTS media (
+            url TEXT PRIMARY KEY, name TEXT, filename TEXT, size INTEGER, md5 TEXT,
+            date REAL, duration REAL, subtitle_url TEXT, file TEXT);
+        CREATE TABLE IF NOT EXISTS category_media (
+            category TEXT, url TEXT, PRIMARY KEY (category, url));
+    '''
+
+    def __init__(self, s: Settings, file: Path):
+        if not sqlite3:
+            msg('--mode=sqlite requires the sqlite3 module')
+            exit(1)
+        super().__init__(s, file)
+
+        if not self.append and self.tmpfile.exists():
+            self.tmpfile.unlink()
+        try:
+            self.db = sqlite3.connect(str(self.tmpfile))
+            self.db.executescript(self.schema)
+        except sqlite3.DatabaseError:
+            raise FileParseError
+
+    def add_category(self, category):
+        # INSERT OR IGNORE leaves existing rows alone, like --append does for the other modes
+        self.db.execute('INSERT OR IGNORE INTO category VALUES (?, ?, ?)',
+                        (category.key, category.name, category.home))
+        self.db.executemany('INSERT OR IGNORE INTO subcategory VALUES (?, ?)',
+                            ((category.key, c.key) for c in category.contents if isinstance(c, Category)))
+        self.db.executemany('INSERT OR IGNORE INTO category_media VALUES (?, ?)',
+                            ((category.key, m.url) for m in category.contents if isinstance(m, Media)))
+
+    def add_media(self, media, category, source):
+        self.db.execute('INSERT OR IGNORE INTO category_media VALUES (?, ?)', (category.key, media.url))
+        self.db.execute('INSERT OR IGNORE INTO media VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (media.url, media.name, media.filename, media.size, media.md5,
+                         media.date, media.duration, media.subtitle_url, source))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+        super().close()
+
+
+def sort_media(media_list: List[Media], sort: str, limit=0) -> List[Media]:
+    """Return a sorted list of Media objects
+
+    :param limit: max number of items to return (0 = all)
+
+    If there is a limit, only the items that make it into the result are
+    sorted, which is a lot faster than sorting a big list and cutting it.
+    Note: "newest" sorts oldest first too, the writers reverse it.
+    """
+    if limit <= 0 or limit >= len(media_list):
+        media_list = media_list.copy()
+        if sort in ('none', ''):
+            pass
+        elif sort == 'name':
+            media_list.sort(key=lambda x: x.name)
+        elif sort in ('newest', 'oldest'):
+            media_list.sort(key=lambda x: x.date)
+        elif sort == 'random':
+            shuffle(media_list)
+        else:
+            raise RuntimeError
+        return media_list
 
     if sort in ('none', ''):
-        return
+        return media_list[:limit]
     elif sort == 'name':
-        media_list.sort(key=lambda x: x.name)
-    elif sort in ('newest', 'oldest'):
-        media_list.sort(key=lambda x: x.date)
+        return heapq.nsmallest(limit, media_list, key=lambda x: x.name)
+    elif sort == 'newest':
+        result = heapq.nlargest(limit, media_list, key=lambda x: x.date)
+        result.reverse()
+        return result
+    elif sort == 'oldest':
+        return heapq.nsmallest(limit, media_list, key=lambda x: x.date)
     elif sort == 'random':
-        shuffle(media_list)
+        return sample(media_list, limit)
     else:
         raise RuntimeError
 
@@ -239,6 +480,15 @@ def create_output(s: Settings, data: List[Category]):
         clean_symlinks(s)
         output_filesystem(s, data)
         return
+    elif s.mode == 'jsonl':
+        output_catalog(s, data, JsonlWriter)
+        return
+    elif s.mode == 'sqlite':
+        output_catalog(s, data, SqliteWriter)
+        return
+    elif s.mode == 'html_pages':
+        output_html_pages(s, data)
+        return
     elif s.mode == 'run':
         writer = CommandWriter
     elif s.mode.startswith('html'):
@@ -263,8 +513,17 @@ def create_output(s: Settings, data: List[Category]):
 def output_single(s: Settings, data: List[Category], writercls: Type[AbstractOutputWriter]):
     """Create a concatenated output file"""
 
-    all_media = [item for category in data for item in category.contents if isinstance(item, Media)]
-    sort_media(all_media, s.sort)
+    if s.max_items > 0 or s.max_category_items > 0:
+        # Skip doublets before selecting, or there could be less than --max-items left
+        all_media = {}
+        for category in data:
+            media_items = [m for m in category.contents if isinstance(m, Media)]
+            for media in sort_media(media_items, s.sort, s.max_category_items):
+                all_media.setdefault(media.url, media)
+        all_media = sort_media(list(all_media.values()), s.sort, s.max_items)
+    else:
+        all_media = [item for category in data for item in category.contents if isinstance(item, Media)]
+        all_media = sort_media(all_media, s.sort)
 
     try:
         # Filename falls back to the name of the first category
@@ -284,6 +543,210 @@ def output_single(s: Settings, data: List[Category], writercls: Type[AbstractOut
     writer.dump_queue()
 
 
+def output_catalog(s: Settings, data: List[Category], writercls: Type[CatalogWriter]):
+    """Write all categories and media to a catalog file, one record at a time"""
+
+    if not data:
+        # Nothing to add (and nothing to name the file after)
+        return
+
+    try:
+        # Filename falls back to the name of the first category
+        file = s.work_dir / (s.output_filename or data[0].safe_name + writercls.ext)
+    except CategoryNameError:
+        msg('please specify filename for output')
+        exit(1)
+        raise
+
+    try:
+        writer = writercls(s, file)
+    except FileParseError:
+        msg('badly formatted file: {}'.format(file))
+        exit(1)
+        raise
+
+    for category in data:
+        writer.add_category(category)
+        for media in category.contents:
+            if not isinstance(media, Media):
+                continue
+            if (s.work_dir / s.sub_dir / media.filename).exists():
+                source = relpath(str(s.work_dir / s.sub_dir / media.filename), str(file.parent))
+            else:
+                source = ''
+            writer.add_media(media, category, source)
+
+    writer.close()
+
+
+def output_html_pages(s: Settings, data: List[Category]):
+    """Create an index page, paginated category pages and a catalog for searching
+
+    The catalog (a JSON object in a script file) keeps the state between
+    runs, so with --append only the categories in data get regenerated.
+    Files are only written if their content has changed.
+    """
+    data_dir = s.work_dir / s.sub_dir
+    catalog_file = data_dir / 'catalog.js'
+
+    try:
+        # Filename falls back to the name of the first category
+        index_file = s.work_dir / (s.output_filename or data[0].safe_name + HtmlWriter.ext)
+    except CategoryNameError:
+        msg('please specify filename for output')
+        exit(1)
+        raise
+
+    catalog = {'base': '', 'categories': {}, 'media': {}}
+    if s.append:
+        try:
+            with catalog_file.open(encoding='utf-8') as f:
+                text = f.read()
+            catalog = json.loads(text[text.index('(') + 1:text.rindex(')')])
+        except OSError:
+            pass
+        except ValueError:
+            msg('badly formatted file: {}'.format(catalog_file))
+            exit(1)
+            raise
+
+    # Update the catalog
+    changed = []
+    for category in data:
+        entry = catalog['categories'].setdefault(category.key, {'name': '', 'home': False, 'sub': [], 'media': []})
+        changed.append(category.key)
+        if category.name:
+            entry['name'] = category.name
+        entry['home'] = entry['home'] or category.home
+        subcategories = [c.key for c in category.contents if isinstance(c, Category)]
+        urls = [m.url for m in category.contents if isinstance(m, Media)]
+        if s.append:
+            subcategories = entry['sub'] + subcategories
+            urls = entry['media'] + urls
+        entry['sub'] = list(dict.fromkeys(subcategories))
+        entry['media'] = list(dict.fromkeys(urls))
+        for media in category.contents:
+            if isinstance(media, Media):
+                catalog['media'][media.url] = {'n': media.name, 'f': media.filename, 'd': media.date,
+                                               't': media.duration, 's': media.url}
+
+    if not s.append:
+        # Forget media that is not in any category anymore
+        used = {url for entry in catalog['categories'].values() for url in entry['media']}
+        catalog['media'] = {url: m for url, m in catalog['media'].items() if url in used}
+
+    # Category pages
+    for key in dict.fromkeys(changed):
+        entry = catalog['categories'][key]
+        items = [dict(catalog['media'][url], u=url) for url in entry['media'] if url in catalog['media']]
+        if s.sort == 'name':
+            items.sort(key=lambda x: x['n'])
+        elif s.sort in ('newest', 'oldest'):
+            items.sort(key=lambda x: x['d'] or 0, reverse=s.sort == 'newest')
+        elif s.sort == 'random':
+            shuffle(items)
+        limit = s.max_category_items or s.max_items
+        if limit > 0:
+            items = items[:limit]
+
+        for item in items:
+            # Link to the local file if it exists (pages are in the same directory)
+            local = (data_dir / item['f']).exists()
+            item['s'] = item['f'] if local else item['u']
+            catalog['media'][item['u']].update(s=item['s'], l=local)
+
+        _write_category_pages(s, data_dir, key, entry, items, catalog)
+
+    # Index page with home categories first
+    keys = sorted(catalog['categories'], key=lambda k: (not catalog['categories'][k]['home'],
+                                                         catalog['categories'][k]['name'] or k))
+    base = relpath(str(data_dir), str(index_file.parent)).replace('\\', '/') + '/'
+    catalog['base'] = base
+    lines = [PAGE_HEAD.format(title='JW Broadcasting', placeholder='Search'), '<ul id="list">\n']
+    for key in keys:
+        entry = catalog['categories'][key]
+        lines.append('<li><a href="{}">{}</a> ({})</li>\n'.format(
+            html.escape(base + _page_name(key, 1), quote=True),
+            html.escape(entry['name'] or key),
+            len(entry['media'])))
+    lines.append('</ul>\n')
+    lines.append(INDEX_SEARCH_SCRIPT.format(catalog_url=json.dumps(base + catalog_file.name), limit=PAGE_SIZE))
+    lines.append(PAGE_END)
+
+    data_dir.mkdir(parents=True, exist_ok=True)
+    _write_if_changed(s, catalog_file, 'jwbCatalog(' + json.dumps(catalog, ensure_ascii=False,
+                                                                   separators=(',', ':')) + ');\n')
+    _write_if_changed(s, index_file, ''.join(lines))
+
+
+def _page_name(key: str, number: int):
+    if number == 1:
+        return key + '.html'
+    return '{}-{}.html'.format(key, number)
+
+
+def _write_category_pages(s: Settings, data_dir: Path, key: str, entry: dict, items: list, catalog: dict):
+    """Write the pages of a category, and remove pages that are not needed anymore"""
+
+    title = html.escape(entry['name'] or key)
+    pages = max((len(items) + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+    data_dir.mkdir(parents=True, exist_ok=True)
+
+    for number in range(1, pages + 1):
+        lines = [PAGE_HEAD.format(title=title, placeholder='Filter')]
+
+        nav = []
+        if number > 1:
+            nav.append('<a href="{}">&lt; previous</a>'.format(html.escape(_page_name(key, number - 1), quote=True)))
+        if pages > 1:
+            nav.append('{}/{}'.format(number, pages))
+        if number < pages:
+            nav.append('<a href="{}">next &gt;</a>'.format(html.escape(_page_name(key, number + 1), quote=True)))
+        nav = '<p class="nav">{}</p>\n'.format(' '.join(nav)) if nav else ''
+        lines.append(nav)
+
+        lines.append('<ul id="list">\n')
+        if number == 1:
+            for sub in entry['sub']:
+                sub_entry = catalog['categories'].get(sub, {})
+                lines.append('<li><a href="{}"><b>{}</b></a></li>\n'.format(
+                    html.escape(_page_name(sub, 1), quote=True),
+                    html.escape(sub_entry.get('name') or sub)))
+        for item in items[(number - 1) * PAGE_SIZE:number * PAGE_SIZE]:
+            lines.append('<li><a href="{}">{}</a></li>\n'.format(html.escape(item['s'], quote=True),
+                                                                   html.escape(item['n'])))
+        lines.append('</ul>\n')
+        lines.append(nav)
+        lines.append(PAGE_FILTER_SCRIPT)
+        lines.append(PAGE_END)
+        _write_if_changed(s, data_dir / _page_name(key, number), ''.join(lines))
+
+    # The category may have shrunk
+    number = pages + 1
+    while (data_dir / _page_name(key, number)).exists():
+        (data_dir / _page_name(key, number)).unlink()
+        number += 1
+
+
+def _write_if_changed(s: Settings, file: Path, content: str):
+    """Write a file, unless it already has this content"""
+
+    try:
+        with file.open(encoding='utf-8') as f:
+            if f.read() == content:
+                return
+        if s.quiet < 1:
+            msg('updating: {}'.format(file))
+    except OSError:
+        if s.quiet < 1:
+            msg('creating: {}'.format(file))
+
+    tmpfile = file.with_name(file.name + '.part')
+    with tmpfile.open('w', encoding='utf-8') as f:
+        f.write(content)
+    tmpfile.replace(file)
+
+
 def output_multi(s: Settings, data: List[Category], writercls: Type[AbstractOutputWriter], tree=True):
     """Create a tree of output files
 
@@ -335,7 +798,7 @@ def output_multi(s: Settings, data: List[Category], writercls: Type[AbstractOutp
                     writer.add_to_queue(PlaylistEntry(item.name.upper(), source))
 
         media_items = [m for m in category.contents if isinstance(m, Media)]
-        sort_media(media_items, s.sort)
+        media_items = sort_media(media_items, s.sort, s.max_category_items or s.max_items)
 
         for media in media_items:
             if (data_dir / media.filename).exists():
@@ -1,13 +1,15 @@
+import io
 import json
 import os
 import re
+import threading
 import time
 import urllib.parse
-import urllib.request
-from typing import List, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Set, Union
 from urllib.error import HTTPError
 
-from .common import msg, Settings
+from .common import cache_dir, get_fixtures, msg, open_url, Settings
 
 SAFE_FILENAMES = False
 FRIENDLY_FILENAMES = False
@@ -17,6 +19,65 @@ class CategoryNameError(Exception):
     pass
 
 
+class CategoryCache:
+    """Sub category keys of each category, cached on disk
+
+    With persistent=False, the cache is only kept in memory.
+    """
+
+    # Seconds before a cached entry is considered outdated
+    ttl = 24 * 60 * 60
+
+    def __init__(self, lang, persistent=True):
+        self.file = cache_dir() / 'categories-{}.json'.format(lang) if persistent else None
+        self.data = {}
+        self.lock = threading.Lock()
+        if not persistent:
+            return
+        try:
+            with self.file.open(encoding='utf-8') as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def get(self, key):
+        """Return a list of sub category keys, or None if unknown or outdated"""
+        entry = self.data.get(key)
+        if entry and time.time() - entry['time'] < self.ttl:
+            return entry['subcategories']
+        return None
+
+    def set(self, key, subcategories: List[str]):
+        """Store the sub category keys of a category"""
+        with self.lock:
+            self.data[key] = {'time': time.time(), 'subcategories': subcategories}
+
+    def save(self):
+        if not self.file:
+            return
+        tmpfile = self.file.with_name(self.file.name + '.part')
+        with self.lock:
+            try:
+                with tmpfile.open('w', encoding='utf-8') as f:
+                    json.dump(self.data, f)
+                tmpfile.replace(self.file)
+            except OSError:
+                pass
+
+
+_category_caches = {}
+_category_caches_lock = threading.Lock()
+
+
+def get_category_cache(lang) -> CategoryCache:
+    """Return the (shared) category cache for a language"""
+    with _category_caches_lock:
+        if lang not in _category_caches:
+            # Recordings must contain every request, and replays must not depend on (or change) the cache
+            _category_caches[lang] = CategoryCache(lang, persistent=not get_fixtures())
+        return _category_caches[lang]
+
+
 class Category:
     """Object to put category info in."""
     key = ''
@@ -47,6 +108,7 @@ class Media:
     size = 0
     subtitle_url = ''
     url = ''
+    files = []  # type: List[dict] # all video files to choose from (only kept with --fit)
 
     # misleading use of repr, but it's only for debugging...
     def __repr__(self):
@@ -69,6 +131,18 @@ class Media:
     def friendly_filename(self):
         return self._get_friendly_filename(self.url)
 
+    def set_file(self, j_file: dict):
+        """Use a file from the JSON "files" array"""
+
+        self.url = j_file['progressiveDownloadURL']
+        self.md5 = j_file.get('checksum')
+        self.size = j_file.get('filesize')
+        self.duration = j_file.get('duration')
+        if j_file.get('subtitles'):
+            self.subtitle_url = j_file['subtitles']['url']
+        else:
+            self.subtitle_url = ''
+
     @property
     def subtitle_filename(self):
         if FRIENDLY_FILENAMES:
@@ -93,8 +167,17 @@ def format_filename(string):
 
 
 # Whoops, copied this from the Kodi plug-in
-def get_best_video(videos: list, quality: int, subtitles: bool):
-    """Take an jw JSON array of files and metadata and return the most suitable like (url, size)"""
+def get_best_video(videos: list, quality: int, subtitles: bool, max_size=0):
+    """Take an jw JSON array of files and metadata and return the most suitable like (url, size)
+
+    :param max_size: only consider files up to this size, or the smallest file if none is small enough
+    """
+    if max_size:
+        small = [j for j in videos if (j.get('filesize') or 0) <= max_size]
+        if small:
+            videos = small
+        elif videos:
+            videos = [min(videos, key=lambda j: j.get('filesize') or 0)]
 
     # Rank media files depending on how they match certain criteria
     # Video resolution will be converted to a rank between 2 and 10
@@ -126,125 +209,299 @@ def get_best_video(videos: list, quality: int, subtitles: bool):
     return rankings[-1][1]
 
 
-def get_json(lang, key):
-    """Return loaded JSON from API"""
+class JsonStream:
+    """Minimal incremental JSON reader
 
+    Lets you walk through objects and arrays, and decode one value at a time,
+    without loading all of the data into memory.
+    """
+    whitespace = ' \t\n\r'
+    number_chars = '0123456789.eE+-'
+
+    def __init__(self, file, chunk_size=64 * 1024):
+        """
+        :param file: a text file object
+        """
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Read more data into the buffer, and throw away what has been used"""
+        if self.eof:
+            raise ValueError('unexpected end of JSON data')
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """Skip whitespace and return next character"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            self._fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('expected {} at: {}'.format(char, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def value(self):
+        """Decode and return the next value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer could continue in the next chunk,
+                # and a cut like "12." or "1e" decodes as just the part before the cut
+                cut = isinstance(value, (int, float)) and not isinstance(value, bool) \
+                    and (end == len(self.buffer) or self.buffer[end] in self.number_chars)
+                if not cut or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def _members(self, start, end):
+        self.expect(start)
+        if self.peek() == end:
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self.peek()
+            self.pos += 1
+            if char == end:
+                return
+            if char != ',':
+                raise ValueError('expected , or {} at: {}'.format(end, self.buffer[self.pos - 1:self.pos + 20]))
+
+    def keys(self):
+        """Iterate over the keys of an object (the caller must read each value)"""
+        for _ in self._members('{', '}'):
+            key = self.value()
+            self.expect(':')
+            yield key
+
+    def elements(self):
+        """Iterate over an array (the caller must read each value)"""
+        return self._members('[', ']')
+
+
+def iter_category(lang, key):
+    """Stream a category from the API
+
+    Yields ('subcategory', dict) and ('media', dict) one at a time, and
+    once ('category', dict) with the other fields of the category. This
+    comes first, unless the key and name are placed after the lists.
+    """
     url = 'https://data.jw-api.org/mediator/v1/categories/{}/{}?detailed=1'.format(lang, key)
     try:
-        with urllib.request.urlopen(url) as data:
-            return json.loads(data.read().decode('utf-8'))
+        with open_url(url) as response:
+            yield from parse_category_stream(io.TextIOWrapper(response, encoding='utf-8'))
     except HTTPError as e:
         if e.code == 404:
             e.msg = '{} not found'.format(key)
-            raise e
+        raise
+
+
+def parse_category_stream(file):
+    """Generator for iter_category(), reading from a text file object"""
+
+    stream = JsonStream(file)
+    for top_key in stream.keys():
+        if top_key != 'category':
+            stream.value()
+            continue
+        info = {}
+        sent = False
+        for cat_key in stream.keys():
+            if cat_key in ('subcategories', 'media') and stream.peek() == '[':
+                if not sent and 'key' in info and 'name' in info:
+                    yield 'category', dict(info)
+                    sent = True
+                kind = 'subcategory' if cat_key == 'subcategories' else 'media'
+                for _ in stream.elements():
+                    yield kind, stream.value()
+            else:
+                info[cat_key] = stream.value()
+        if not sent:
+            yield 'category', info
 
 
 def get_categories(s: Settings, key):
     """Return a list of sub category keys"""
 
-    j = get_json(s.lang, key)
-    return [sub['key'] for sub in j['category'].get('subcategories', [])]
+    cache = get_category_cache(s.lang)
+    subcategories = cache.get(key)
+    if subcategories is None:
+        subcategories = []
+        for kind, j in iter_category(s.lang, key):
+            if kind == 'subcategory':
+                subcategories.append(j['key'])
+            elif kind == 'media':
+                # Sub categories are usually listed before media, no need to read more
+                break
+        cache.set(key, subcategories)
+    return subcategories
 
 
-def parse_broadcasting(s: Settings):
-    """Index JW Broadcasting categories recursively and return a list with Category objects
+def get_category_filter(s: Settings, keys: List[str], subtree=False) -> Set[str]:
+    """Return a set with categories and their sub categories
 
-    :param s: Global settings object
+    Categories are fetched in parallel (or taken from cache).
+
+    :keyword subtree: include all levels of sub categories, not just the first
     """
+    result = set()
+    with ThreadPoolExecutor(max_workers=s.jobs) as executor:
+        level = [key for key in keys if key not in s.exclude_categories]
+        while level:
+            result.update(level)
+            if s.quiet < 1:
+                for key in level:
+                    msg('preparing filter: ' + key)
+            next_level = []
+            for subcategories in executor.map(lambda key: get_categories(s, key), level):
+                next_level += [key for key in subcategories
+                               if key not in result and key not in s.exclude_categories]
+            if subtree:
+                level = list(dict.fromkeys(next_level))
+            else:
+                result.update(next_level)
+                break
+    get_category_cache(s.lang).save()
+    return result
+
+
+def parse_media(s: Settings, j_media: dict):
+    """Create a Media object from JSON, or return None if it should be skipped"""
+
+    # Skip videos marked as hidden
+    if 'tags' in j_media.get('tags', []):
+        return None
+    # Apply category filter
+    if s.filter_categories and j_media['primaryCategory'] not in s.filter_categories:
+        return None
+    try:
+        if j_media.get('type') == 'audio':
+            # Simply pick first audio stream for the time being...
+            j_media_file = j_media['files'][0]
+        else:
+            # Note: empty list will raise IndexError
+            j_media_file = get_best_video(j_media['files'], quality=s.quality, subtitles=s.hard_subtitles)
+    except IndexError:
+        if s.quiet < 1:
+            msg('no media files found for: {}'.format(j_media['title']))
+        return None
+
+    media = Media()
+    media.name = j_media['title']
+    media.set_file(j_media_file)
+    if s.fit_items and j_media.get('type') != 'audio':
+        media.files = j_media['files']
+
+    # Save time data
+    if 'firstPublished' in j_media:
+        try:
+            # Remove last stuff from date, what is it anyways?
+            date_string = re.sub('\\.[0-9]+Z$', '', j_media['firstPublished'])
+            # Try to convert it to seconds
+            date = time.mktime(time.strptime(date_string, '%Y-%m-%dT%H:%M:%S'))
+            if date < s.min_date:
+                return None
+            media.date = date
+        except ValueError:
+            if s.quiet < 1:
+                msg('could not get timestamp on: {}'.format(j_media['title']))
+
+    return media
+
+
+def set_filename_style(s: Settings):
+    """Apply the settings that Media.filename depends on"""
+
     # TODO this is really ugly
     global FRIENDLY_FILENAMES, SAFE_FILENAMES
     FRIENDLY_FILENAMES = s.friendly_filenames
     SAFE_FILENAMES = s.safe_filenames
 
+
+def parse_broadcasting(s: Settings):
+    """Index JW Broadcasting categories recursively and return a list with Category objects
+
+    :param s: Global settings object
+    """
+    set_filename_style(s)
+
     # Make a copy because we'll append stuff here later
     queue = s.include_categories.copy()
     result = []
 
     for key in queue:
-        j = get_json(s.lang, key)
-
         cat = Category()
-        cat.key = j['category']['key']
-        cat.name = j['category']['name']
-        cat.home = cat.key in s.include_categories
+        cat.key = key
         if not s.update:
             result.append(cat)
+        subcategories = []
+
+        for kind, j in iter_category(s.lang, key):
+
+            if kind == 'category':
+                cat.key = j['key']
+                cat.name = j['name']
+                cat.home = cat.key in s.include_categories
 
-        if s.quiet < 1:
-            msg('indexing: {} ({})'.format(cat.key, cat.name))
-
-        for j_sub in j['category'].get('subcategories', []):
-
-            sub = Category()
-            sub.key = j_sub['key']
-            sub.name = j_sub['name']
-            # Note:
-            # We always add an sub-category entry
-            # but sometimes it is --exclude'ed so it won't get parsed
-            # This will create broken symlinks etc
-            # But if script is re-run with these categories included, the links will start to work
-            # We call it implementation detail instead of bug...
-            cat.contents.append(sub)
-            # Add subcategory key to queue for parsing later
-            if sub.key not in queue and sub.key not in s.exclude_categories:
-                queue.append(sub.key)
-
-        for j_media in j['category'].get('media', []):
-            # Skip videos marked as hidden
-            if 'tags' in j_media.get('tags', []):
-                continue
-            # Apply category filter
-            if s.filter_categories and j_media['primaryCategory'] not in s.filter_categories:
-                continue
-            try:
-                if j_media.get('type') == 'audio':
-                    # Simply pick first audio stream for the time being...
-                    j_media_file = j_media['files'][0]
-                else:
-                    # Note: empty list will raise IndexError
-                    j_media_file = get_best_video(j_media['files'], quality=s.quality, subtitles=s.hard_subtitles)
-            except IndexError:
                 if s.quiet < 1:
-                    msg('no media files found for: {}'.format(j_media['title']))
-                continue
-
-            media = Media()
-            media.url = j_media_file['progressiveDownloadURL']
-            media.name = j_media['title']
-            media.md5 = j_media_file.get('checksum')
-            media.size = j_media_file.get('filesize')
-            media.duration = j_media_file.get('duration')
-            if j_media_file.get('subtitles'):
-                media.subtitle_url = j_media_file['subtitles']['url']
-
-            # Save time data
-            if 'firstPublished' in j_media:
-                try:
-                    # Remove last stuff from date, what is it anyways?
-                    date_string = re.sub('\\.[0-9]+Z$', '', j_media['firstPublished'])
-                    # Try to convert it to seconds
-                    date = time.mktime(time.strptime(date_string, '%Y-%m-%dT%H:%M:%S'))
-                    if date < s.min_date:
-                        continue
-                    media.date = date
-                except ValueError:
-                    if s.quiet < 1:
-                        msg('could not get timestamp on: {}'.format(j_media['title']))
-
-            if s.update:
-                try:
-                    # Find a previously added category
-                    pcat = next(c for c in result if c.key == j_media["primaryCategory"])
-                except StopIteration:
-                    # Create a new homeless category
-                    pcat = Category()
-                    pcat.key = j_media["primaryCategory"]
-                    pcat.home = False
-                    result.append(pcat)
-                # Add media to its primary category
-                pcat.contents.append(media)
-            else:
-                # Add media to current category
-                cat.contents.append(media)
+                    msg('indexing: {} ({})'.format(cat.key, cat.name))
+
+            elif kind == 'subcategory':
+                sub = Category()
+                sub.key = j['key']
+                sub.name = j['name']
+                subcategories.append(sub.key)
+                # Note:
+                # We always add an sub-category entry
+                # but sometimes it is --exclude'ed so it won't get parsed
+                # This will create broken symlinks etc
+                # But if script is re-run with these categories included, the links will start to work
+                # We call it implementation detail instead of bug...
+                cat.contents.append(sub)
+                # Add subcategory key to queue for parsing later
+                if sub.key not in queue and sub.key not in s.exclude_categories:
+                    queue.append(sub.key)
+
+            elif kind == 'media':
+                media = parse_media(s, j)
+                if not media:
+                    continue
+
+                if s.update:
+                    try:
+                        # Find a previously added category
+                        pcat = next(c for c in result if c.key == j["primaryCategory"])
+                    except StopIteration:
+                        # Create a new homeless category
+                        pcat = Category()
+                        pcat.key = j["primaryCategory"]
+                        pcat.home = False
+                        result.append(pcat)
+                    # Add media to its primary category
+                    pcat.contents.append(media)
+                else:
+                    # Add media to current category
+                    cat.contents.append(media)
+
+        get_category_cache(s.lang).set(cat.key, subcategories)
 
+    get_category_cache(s.lang).save()
     return result
@@ -1,11 +1,18 @@
 import argparse
 import json
+import os
 import signal
 import subprocess
+import threading
 import time
 from random import shuffle
 
-from jwlib.common import Path, msg
+from jwlib.common import Path, metrics, msg
+
+# Seconds to wait after the player has started before warming up the next video,
+# so we don't compete with the player for the disk while it is buffering
+PRELOAD_DELAY = 5
+
 
 class VideoManager:
     """Main class of jwb-offline
@@ -13,22 +20,29 @@ class VideoManager:
     Play video files, keep track of history
     """
     video = None  # type: Path
+    next_video = None  # type: Path
     start_time = None  # type: float
     pos = 0
     errors = 0
 
-    def __init__(self, wd: Path, replay=0, cmd=None, verbose=False):
+    def __init__(self, wd: Path, replay=0, cmd=None, verbose=False, preload=0, metrics_file=None):
         """Initialize self.
 
         :param wd: working directory
         :keyword replay: seconds to replay of last video
         :keyword cmd: list with video player command
+        :keyword preload: bytes to read ahead from the start of the next video
+        :keyword metrics_file: write Prometheus metrics here after each video
         """
+        self.metrics_file = metrics_file
         self.replay = replay
         self.wd = wd
         self.dump_file = wd / 'dump.json'
         self.history = []
         self.verbose = verbose
+        self.preload = preload
+        # Guards next_video against a preload thread that outlives its playback
+        self.lock = threading.Lock()
 
         if cmd and len(cmd) > 0:
             self.cmd = cmd
@@ -60,15 +74,53 @@ class VideoManager:
         if self.video:
             self.start_time = time.time()
             return True
+        # Use the video that was chosen (and preloaded) during the last playback
+        if self.next_video and self.next_video.exists():
+            self.video = self.next_video
+        else:
+            self.video = self.pick_random_video()
+        self.next_video = None
+        self.pos = 0
+        return self.video is not None
+
+    def pick_random_video(self, exclude=None):
+        """Return a random video that is not in the history (or None)"""
         files = self.list_videos()
         shuffle(files)
         for vid in files:
-            if vid in self.history:
+            if str(vid) in self.history or vid == exclude:
                 continue
-            self.video = vid
-            self.pos = 0
-            return True
-        return False
+            return vid
+        return None
+
+    def preload_next_video(self, current: Path, stopped: threading.Event):
+        """Choose the next video and warm up its beginning in the page cache
+
+        :param current: the video that is playing
+        :param stopped: set when that playback has ended (the choice is thrown away)
+        """
+        if stopped.wait(PRELOAD_DELAY):
+            return
+        vid = self.pick_random_video(exclude=current)
+        if not vid:
+            return
+        with self.lock:
+            if stopped.is_set():
+                return
+            self.next_video = vid
+        try:
+            with vid.open('rb') as f:
+                if hasattr(os, 'posix_fadvise'):
+                    # Let the kernel read ahead in the background
+                    os.posix_fadvise(f.fileno(), 0, self.preload, os.POSIX_FADV_WILLNEED)
+                else:
+                    # Read the data ourselves and throw it away
+                    buffer = bytearray(1024 * 1024)
+                    remaining = self.preload
+                    while remaining > 0 and f.readinto(buffer):
+                        remaining -= len(buffer)
+        except OSError:
+            pass
 
     def calculate_pos(self):
         """Calculate the playback position in the currently playing video"""
@@ -87,24 +139,53 @@ class VideoManager:
         cmd = [arg.replace('{}', str(self.pos)) for arg in self.cmd] + [str(self.video)]
         self.start_time = time.time()
         if self.verbose:
-            subprocess.call(cmd)
+            process = subprocess.Popen(cmd)
         else:
-            subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        stopped = threading.Event()
+        if self.preload:
+            threading.Thread(target=self.preload_next_video, args=(self.video, stopped), daemon=True).start()
+
+        # Same as subprocess.call()
+        with process:
+            try:
+                process.wait()
+            except:
+                process.kill()
+                raise
+            finally:
+                with self.lock:
+                    stopped.set()
 
         if self.calculate_pos() == 0:
             self.errors = self.errors + 1
+            metrics.inc('jwb_offline_player_errors_total')
         else:
             self.errors = 0
+            metrics.inc('jwb_offline_videos_played_total')
+        self.write_metrics()
         if self.errors > 10:
             raise RuntimeError('video player restarting too quickly')
 
         self.add_to_history(self.video)
         self.video = None
 
+    def write_metrics(self):
+        """Write Prometheus metrics file (if enabled)"""
+        if not self.metrics_file:
+            return
+        files = self.list_videos()
+        metrics.set('jwb_offline_library_files', len(files))
+        metrics.set('jwb_offline_library_bytes', sum(f.size for f in files))
+        metrics.set('jwb_offline_last_video_timestamp_seconds', time.time())
+        metrics.write(self.metrics_file)
+
     def add_to_history(self, video):
         """Add a video to the history and trim it to half of the amount of videos"""
         max_len = len(self.list_videos()) // 2
-        self.history.append(video)
+        # Store as string so it can be dumped to JSON
+        self.history.append(str(video))
         self.history = self.history[-max_len:]
 
     def list_videos(self):
@@ -140,6 +221,15 @@ def main():
                         default=30,
                         dest='replay',
                         help='seconds to replay after a restart')
+    parser.add_argument('--metrics',
+                        metavar='FILE',
+                        type=Path,
+                        help='write Prometheus metrics to this file (for the textfile collector)')
+    parser.add_argument('--preload',
+                        metavar='MiB',
+                        type=int,
+                        default=0,
+                        help='read ahead this much of the next video while playing (default = 0 = off)')
     parser.add_argument('--verbose',
                         action='store_true',
                         help='show video player output')
@@ -147,7 +237,8 @@ def main():
     args = parser.parse_args()
     args.dir = Path(args.dir)
 
-    m = VideoManager(args.dir, replay=args.replay, cmd=args.cmd, verbose=args.verbose)
+    m = VideoManager(args.dir, replay=args.replay, cmd=args.cmd, verbose=args.verbose,
+                     preload=args.preload * 1024 * 1024, metrics_file=args.metrics)
 
     try:
         m.read_dump()